@@ -0,0 +1,114 @@
+import os
+import json
+import codecs
+import base64
+import hashlib
+
+# Multiple of 3 so each chunk's base64 can be concatenated without padding in between
+CHUNK_SIZE = 3 * 64 * 1024
+# Binary files at least this big are streamed instead of read into memory
+STREAM_SIZE = 1024 * 1024
+PLACEHOLDER = '__floo_b64stream__'
+
+
+def encoded_len(size):
+    return 4 * ((size + 2) // 3)
+
+
+def scan(path):
+    ''' Returns (size, md5, is_utf8) of the file at path without keeping its contents around. '''
+    size = 0
+    md5 = hashlib.md5()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    utf8 = True
+    with open(path, 'rb') as fd:
+        while True:
+            data = fd.read(CHUNK_SIZE)
+            if not data:
+                break
+            size += len(data)
+            md5.update(data)
+            if utf8:
+                try:
+                    decoder.decode(data)
+                except UnicodeDecodeError:
+                    utf8 = False
+    if utf8:
+        try:
+            decoder.decode(b'', True)
+        except UnicodeDecodeError:
+            utf8 = False
+    return size, md5.hexdigest(), utf8
+
+
+def decode_to_file(data, path, expected_md5=None):
+    ''' Writes base64 data to path a chunk at a time. Returns the md5 of the decoded data.
+    If it isn't expected_md5, path is left alone. '''
+    md5 = hashlib.md5()
+    step = encoded_len(CHUNK_SIZE)
+    tmp_path = path + '.floo_tmp'
+    with open(tmp_path, 'wb') as fd:
+        for i in range(0, len(data), step):
+            chunk = base64.b64decode(data[i:i + step])
+            md5.update(chunk)
+            fd.write(chunk)
+    digest = md5.hexdigest()
+    if expected_md5 is not None and digest != expected_md5:
+        os.remove(tmp_path)
+        return digest
+    if os.path.exists(path):
+        # Windows won't rename over an existing file
+        os.remove(path)
+    os.rename(tmp_path, path)
+    return digest
+
+
+class Base64File(object):
+    ''' A binary file's contents as base64, read and encoded a chunk at a time as it's sent.
+
+    size is what scan() found. If the file is shorter by the time we send it, chunks() raises IOError.
+    '''
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def __len__(self):
+        return encoded_len(self.size)
+
+    def chunks(self):
+        left = self.size
+        with open(self.path, 'rb') as fd:
+            while left > 0:
+                data = fd.read(min(CHUNK_SIZE, left))
+                if not data:
+                    raise IOError('%s changed while it was being sent' % self.path)
+                left -= len(data)
+                yield base64.b64encode(data)
+
+
+class Frame(object):
+    ''' An encoded message whose 'buf' is a Base64File. See frame(). '''
+
+    def __init__(self, head, stream, tail):
+        self.head = head
+        self.stream = stream
+        self.tail = tail
+
+    def __len__(self):
+        return len(self.head) + len(self.stream) + len(self.tail)
+
+    def chunks(self):
+        yield self.head
+        for chunk in self.stream.chunks():
+            yield chunk
+        yield self.tail
+
+
+def frame(item):
+    ''' Returns item as a Frame. The same bytes as json.dumps(item) + '\\n' once the file is read. '''
+    stream = item['buf']
+    item = dict(item)
+    item['buf'] = PLACEHOLDER
+    head, tail = (json.dumps(item) + '\n').split('"%s"' % PLACEHOLDER, 1)
+    return Frame(head.encode('utf-8') + b'"', stream, b'"' + tail.encode('utf-8'))
@@ -0,0 +1,48 @@
+import collections
+
+
+class BlobCache(object):
+    ''' md5 of file contents -> (buf, encoding) as we send it to the server.
+
+    Lets identical files (vendored copies, fixtures, duplicated assets) skip reading,
+    decoding and base64ing after the first one. The least recently used blobs go once
+    the total size passes max_size.
+    '''
+    MAX_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.bytes_saved = 0
+        self._blobs = collections.OrderedDict()
+
+    def __contains__(self, md5):
+        return md5 in self._blobs
+
+    def get(self, md5):
+        blob = self._blobs.pop(md5, None)
+        if blob is None:
+            return None
+        self._blobs[md5] = blob
+        self.hits += 1
+        self.bytes_saved += len(blob[0])
+        return blob
+
+    def set(self, md5, buf, encoding):
+        size = len(buf)
+        # Don't let one huge file push out everything else
+        if md5 in self._blobs or size > self.max_size / 8:
+            return
+        self._blobs[md5] = (buf, encoding)
+        self.size += size
+        while self.size > self.max_size:
+            md5, blob = self._blobs.popitem(last=False)
+            self.size -= len(blob[0])
+
+    def clear(self):
+        self._blobs.clear()
+        self.size = 0
+
+    def stats(self):
+        return '%s duplicate files, %s bytes not read or encoded again' % (self.hits, self.bytes_saved)
@@ -0,0 +1,134 @@
+import os
+import hashlib
+import collections
+
+try:
+    from . import hash_cache, msg, utils
+    from .exc_fmt import str_e
+except ImportError:
+    import hash_cache
+    import msg
+    import utils
+    from exc_fmt import str_e
+
+
+class BufStore(dict):
+    ''' Buf id -> buf, with the total size of buf contents kept under a budget.
+
+    touch() marks a buf as recently used and updates its size. Call it whenever
+    buf['buf'] changes. When we're over budget, the least recently used bufs that
+    can_evict(buf) allows lose their contents. If none of them can, we don't look
+    again until another buf is loaded. If the file on disk already matches
+    (according to the hash cache) the buf is just marked unloaded. Otherwise the
+    contents go to a file in spill_dir named by their md5. FlooHandler.load_buf()
+    brings them back.
+    '''
+
+    def __init__(self, budget, spill_dir, can_evict, cache=None):
+        super(BufStore, self).__init__()
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.can_evict = can_evict
+        self.cache = cache
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._sizes = {}
+        # Buf ids with contents in memory, least recently used first
+        self._lru = collections.OrderedDict()
+        # Bumped when a buf is loaded. Eviction is skipped while it's still what it was when nothing could go.
+        self._generation = 0
+        self._stuck_at = None
+        self._spilled = set()
+
+    def __setitem__(self, buf_id, buf):
+        super(BufStore, self).__setitem__(buf_id, buf)
+        self.touch(buf_id)
+
+    def __delitem__(self, buf_id):
+        super(BufStore, self).__delitem__(buf_id)
+        self._forget(buf_id)
+
+    def pop(self, buf_id, *args):
+        self._forget(buf_id)
+        return super(BufStore, self).pop(buf_id, *args)
+
+    def touch(self, buf_id):
+        buf = self.get(buf_id)
+        if not isinstance(buf, dict):
+            return
+        size = len(buf.get('buf') or '')
+        self.used += size - self._sizes.get(buf_id, 0)
+        self._sizes[buf_id] = size
+        if buf_id in self._lru:
+            del self._lru[buf_id]
+        elif size:
+            self._generation += 1
+        if size:
+            self._lru[buf_id] = None
+        if self.budget and self.used > self.budget and self._stuck_at != self._generation:
+            self.evict(buf_id)
+
+    def evict(self, keep=None):
+        for buf_id in list(self._lru):
+            if self.used <= self.budget:
+                break
+            buf = self.get(buf_id)
+            if buf_id == keep or not self.can_evict(buf):
+                continue
+            try:
+                self._evict(buf)
+            except Exception as e:
+                msg.error('Error evicting buffer ', buf['path'], ': ', str_e(e))
+                continue
+            self.used -= self._sizes[buf_id]
+            self._sizes[buf_id] = 0
+            del self._lru[buf_id]
+            self.evictions += 1
+        self._stuck_at = self.used > self.budget and self._generation or None
+        msg.debug('Buffer store: ', self.stats())
+
+    def read_spilled(self, buf):
+        with open(os.path.join(self.spill_dir, buf['spilled']), 'rb') as fd:
+            data = fd.read()
+        if buf['encoding'] == 'utf8':
+            data = data.decode('utf-8')
+        return data
+
+    def clear_spilled(self):
+        for name in self._spilled:
+            try:
+                os.remove(os.path.join(self.spill_dir, name))
+            except (IOError, OSError):
+                pass
+        self._spilled = set()
+
+    def stats(self):
+        return '%s/%s bytes in memory, %s hits, %s misses, %s evictions' % (self.used, self.budget, self.hits, self.misses, self.evictions)
+
+    def _evict(self, buf):
+        kind = buf['encoding'] == 'utf8' and hash_cache.TEXT or hash_cache.RAW
+        sig = hash_cache.signature(utils.get_full_path(buf['path']))
+        if self.cache and self.cache.get(buf['path'], sig, kind) == buf['md5']:
+            msg.debug('Evicting ', buf['path'], '. It\'s on disk.')
+            del buf['buf']
+            buf['unloaded'] = True
+            return
+        data = buf['buf']
+        if buf['encoding'] == 'utf8':
+            data = data.encode('utf-8')
+        name = hashlib.md5(data).hexdigest()
+        path = os.path.join(self.spill_dir, name)
+        if name not in self._spilled:
+            utils.mkdir(self.spill_dir)
+            with open(path, 'wb') as fd:
+                fd.write(data)
+            self._spilled.add(name)
+        msg.debug('Evicting ', buf['path'], ' to ', path)
+        del buf['buf']
+        buf['spilled'] = name
+
+    def _forget(self, buf_id):
+        self.used -= self._sizes.pop(buf_id, 0)
+        self._lru.pop(buf_id, None)
@@ -0,0 +1,135 @@
+import collections
+import hashlib
+import mmap
+import threading
+
+try:
+    import queue
+    assert queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import io
+except ImportError:
+    io = None
+
+try:
+    from . import hash_cache
+except ImportError:
+    import hash_cache
+
+# Files at least this big get hashed straight out of an mmap
+MMAP_SIZE = 1024 * 1024
+
+
+def read_buf(path, encoding):
+    ''' Returns (contents, md5) of the file at path, the same way the server hashes a buf. '''
+    if encoding == 'utf8':
+        if io:
+            buf_fd = io.open(path, 'rt', encoding='utf8')
+            buf_buf = buf_fd.read()
+        else:
+            buf_fd = open(path, 'rb')
+            buf_buf = buf_fd.read().decode('utf-8').replace('\r\n', '\n')
+        md5 = hashlib.md5(buf_buf.encode('utf-8')).hexdigest()
+    else:
+        buf_fd = open(path, 'rb')
+        buf_buf = buf_fd.read()
+        md5 = hashlib.md5(buf_buf).hexdigest()
+    buf_fd.close()
+    return buf_buf, md5
+
+
+def mmap_md5(path, encoding):
+    ''' Hashes a big file without reading it into memory. Returns None if the md5 wouldn't match
+    what read_buf() computes (text with \\r in it gets its newlines rewritten). '''
+    with open(path, 'rb') as fd:
+        mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if encoding == 'utf8' and mm.find(b'\r') != -1:
+            return None
+        return hashlib.md5(mm).hexdigest()
+    finally:
+        mm.close()
+
+
+class FileHasher(object):
+    ''' Reads and hashes bufs' files on background threads.
+
+    Results are (buf, sig, contents, md5, error) tuples returned by poll() in the
+    order they finish. contents is None if the file was big and matched the buf's
+    md5, or if the hash cache already knew it matched. Either way it doesn't need
+    to be read until someone uses it.
+    '''
+    THREADS = 4
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.total = 0
+        self.finished = 0
+        self.cancelled = False
+        self._jobs = queue.Queue()
+        self._results = collections.deque()
+        self._threads = []
+
+    def add(self, buf, path):
+        self.total += 1
+        if len(self._threads) < self.THREADS:
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        self._jobs.put((buf, path))
+
+    def done(self):
+        return self.finished >= self.total
+
+    def poll(self):
+        results = []
+        while self._results:
+            results.append(self._results.popleft())
+        self.finished += len(results)
+        if self.done():
+            self.stop()
+        return results
+
+    def cancel(self):
+        self.cancelled = True
+        try:
+            while True:
+                self._jobs.get_nowait()
+        except queue.Empty:
+            pass
+        self.stop()
+
+    def stop(self):
+        for t in self._threads:
+            self._jobs.put(None)
+        self._threads = []
+
+    def _hash(self, buf, path):
+        sig = hash_cache.signature(path)
+        if sig is None:
+            raise IOError('Can\'t stat %s' % path)
+        kind = buf['encoding'] == 'utf8' and hash_cache.TEXT or hash_cache.RAW
+        if self.cache and self.cache.get(buf['path'], sig, kind) == buf['md5']:
+            return sig, None, buf['md5']
+        if sig[0] >= MMAP_SIZE:
+            md5 = mmap_md5(path, buf['encoding'])
+            if md5 == buf['md5']:
+                return sig, None, md5
+        buf_buf, md5 = read_buf(path, buf['encoding'])
+        return sig, buf_buf, md5
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None or self.cancelled:
+                return
+            buf, path = job
+            try:
+                sig, buf_buf, md5 = self._hash(buf, path)
+                self._results.append((buf, sig, buf_buf, md5, None))
+            except Exception as e:
+                self._results.append((buf, None, None, None, e))
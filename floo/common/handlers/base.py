@@ -7,6 +7,15 @@ except ValueError:
 from .. import msg, event_emitter, shared as G, utils
 
 
+def _reactor():
+    # reactor imports handlers.tcp_server, which imports this module. A top level import would be circular.
+    try:
+        from ..reactor import reactor
+    except (ImportError, ValueError):
+        from floo.common.reactor import reactor
+    return reactor
+
+
 class BaseHandler(event_emitter.EventEmitter):
     PROTOCOL = None
 
@@ -47,6 +56,8 @@ class BaseHandler(event_emitter.EventEmitter):
 
         if cb:
             self.cbs[req_id] = cb
+
+        _reactor().wake()
         return req_id
 
     def on_data(self, name, data):
@@ -91,17 +102,19 @@ class BaseHandler(event_emitter.EventEmitter):
         self.stop()
 
     def stop(self):
-        from .. import reactor
         if self.req_ids:
             msg.warn("Unresponded msgs", self.req_ids)
             self.req_ids = {}
         self.cbs = {}
-        reactor.reactor.stop_handler(self)
+        _reactor().stop_handler(self)
         if G.AGENT is self:
             G.AGENT = None
 
     def is_ready(self):
         return self.joined_workspace
 
+    def is_busy(self):
+        return False
+
     def tick(self):
         pass
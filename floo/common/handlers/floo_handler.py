@@ -11,7 +11,7 @@ try:
     from . import base
     from ..reactor import reactor
     from ..lib import DMP
-    from .. import msg, ignore, repo, shared as G, utils
+    from .. import b64stream, blob_cache, buf_store, file_hasher, hash_cache, msg, ignore, repo, shared as G, upload_manifest, upload_pacer, utils
     from ..exc_fmt import str_e
     from ... import editor
     from ..protocols import floo_proto
@@ -21,7 +21,7 @@ except (ImportError, ValueError) as e:
     from floo.common.lib import DMP
     from floo.common.reactor import reactor
     from floo.common.exc_fmt import str_e
-    from floo.common import msg, ignore, repo, shared as G, utils
+    from floo.common import b64stream, blob_cache, buf_store, file_hasher, hash_cache, msg, ignore, repo, shared as G, upload_manifest, upload_pacer, utils
     from floo.common.protocols import floo_proto
 
 try:
@@ -29,11 +29,6 @@ try:
 except NameError:
     unicode = str
 
-try:
-    import io
-except ImportError:
-    io = None
-
 
 MAX_WORKSPACE_SIZE = 200000000  # 200MB
 TOO_BIG_TEXT = '''Maximum workspace size is %.2fMB.\n
@@ -42,6 +37,12 @@ TOO_BIG_TEXT = '''Maximum workspace size is %.2fMB.\n
 
 class FlooHandler(base.BaseHandler):
     PROTOCOL = floo_proto.FlooProtocol
+    # Max get_bufs the background trickle keeps outstanding when G.LAZY_HYDRATION is on
+    HYDRATE_IN_FLIGHT = 8
+    # ms to wait for a reply to resync_buf() before fetching the whole buf
+    RESYNC_TIMEOUT = 10000
+    # Local files modified this recently (seconds) are fetched right away even when hydrating lazily
+    RECENT_TIME = 60 * 60
 
     def __init__(self, owner, workspace, auth, action):
         self.username = auth.get('username')
@@ -53,6 +54,18 @@ class FlooHandler(base.BaseHandler):
         self.workspace = workspace
         self.action = action
         self.upload_timeout = None
+        self.upload_pacer = None
+        # (paths iterator, upload func) for the upload in progress, in order. See _rate_limited_upload().
+        self.upload_queue = collections.deque()
+        self.upload_manifest = None
+        self.blob_cache = blob_cache.BlobCache()
+        self.hash_cache = None
+        self.scan_hasher = None
+        self.scan_timeout = None
+        self.connection_id = 0
+        self.hydrate_timeout = None
+        self.patch_flush_timeout = None
+        self.bufs = None
         self.reset()
 
     def _on_highlight(self, data):
@@ -100,14 +113,138 @@ class FlooHandler(base.BaseHandler):
         msg.warn('Syncing buffer ', buf['path'], ' for consistency.')
         if 'buf' in buf:
             del buf['buf']
+        buf.pop('unloaded', None)
+        buf.pop('spilled', None)
+        buf.pop('resync_md5', None)
+        self.bufs.touch(buf_id)
+        self._lock_view(view)
+
+    def resync_buf(self, buf_id, view=None):
+        """ Like get_buf(), but asks for a patch from what we have instead of the whole buf.
+        Servers that can't do that reply with the whole buf anyway. """
+        buf = self.bufs.get(buf_id)
+        if not buf:
+            return
+        if buf['encoding'] != 'utf8' or buf.get('buf') is None:
+            return self.get_buf(buf_id, view)
+        if buf.get('resync_md5'):
+            msg.debug('Already resyncing ', buf['path'])
+            return
+        self.send({
+            'name': 'get_buf',
+            'id': buf_id,
+            'md5': buf['md5'],
+        })
+        msg.warn('Syncing buffer ', buf['path'], ' for consistency.')
+        # Patches that arrive before the reply are already in it
+        buf['resync_md5'] = buf['md5']
+        utils.cancel_timeout(buf.get('timeout_id'))
+        buf['timeout_id'] = utils.set_timeout(self._resync_timed_out, self.RESYNC_TIMEOUT, buf_id, view)
+        self._lock_view(view)
 
-        if view:
-            view.set_read_only(True)
-            view.set_status('Floobits locked this file until it is synced.')
+    def _resync_timed_out(self, buf_id, view):
+        buf = self.bufs.get(buf_id)
+        if not buf or not buf.get('resync_md5'):
+            return
+        buf.pop('timeout_id', None)
+        msg.warn('No reply syncing ', buf['path'], '. Getting the whole thing.')
+        self.get_buf(buf_id, view)
+
+    def _lock_view(self, view):
+        if not view:
+            return
+        view.set_read_only(True)
+        view.set_status('Floobits locked this file until it is synced.')
+        try:
+            del G.VIEW_TO_HASH[view.native_id]
+        except Exception:
+            pass
+
+    def load_buf(self, buf, touch=True):
+        """ Reads a buf that _scan_dir found unchanged on disk but didn't keep in memory.
+        Returns True if buf['buf'] is populated. Pass touch=False for lookups that don't
+        use the contents (eg: selection changes) so they don't count as a use. """
+        if buf.get('buf') is not None:
+            if touch:
+                self.bufs.hits += 1
+                self.bufs.touch(buf['id'])
+            return True
+        if buf.get('spilled'):
             try:
-                del G.VIEW_TO_HASH[view.native_id]
-            except Exception:
-                pass
+                buf['buf'] = self.bufs.read_spilled(buf)
+            except Exception as e:
+                msg.error('Error reading evicted buffer ', buf['path'], ': ', str_e(e))
+                self.get_buf(buf['id'])
+                return False
+            del buf['spilled']
+            self.bufs.misses += 1
+            self.bufs.touch(buf['id'])
+            return True
+        if buf['id'] in self.hydrate_pending:
+            # Somebody wants it. Don't wait for the trickle.
+            self._hydrate(buf['id'])
+            return False
+        if not buf.pop('unloaded', False):
+            return False
+        try:
+            buf_buf, md5 = self._read_buf(buf)
+        except Exception as e:
+            msg.debug('Error reading ', buf['path'], ': ', str_e(e))
+            self.get_buf(buf['id'])
+            return False
+        if md5 != buf['md5']:
+            msg.log(buf['path'], ' changed on disk since joining.')
+            self._send_local_changes(buf)
+            return False
+        buf['buf'] = buf_buf
+        self.bufs.misses += 1
+        self.bufs.touch(buf['id'])
+        return True
+
+    def _can_evict(self, buf):
+        # Views and their patches expect buf['buf'] to stick around
+        return not buf.get('view') and not self.get_view(buf['id'])
+
+    def _stomp_local(self, bufs):
+        """ Replaces local copies of bufs with the workspace's. With G.LAZY_HYDRATION, only bufs
+        that are open or were touched recently are fetched now. The rest trickle in. """
+        for buf in bufs:
+            self.save_on_get_bufs.add(buf['id'])
+            if not G.LAZY_HYDRATION or self._is_hot(buf):
+                self.get_buf(buf['id'], buf.get('view'))
+                continue
+            # Don't patch stale text. load_buf() fetches it if somebody needs it first.
+            buf.pop('buf', None)
+            buf.pop('unloaded', None)
+            self.hydrate_pending.add(buf['id'])
+            self.hydrate_queue.append(buf['id'])
+        if self.hydrate_queue and self.hydrate_timeout is None:
+            msg.log('Fetching ', len(self.hydrate_queue), ' buffers in the background.')
+            self.hydrate_timeout = utils.set_interval(self._trickle_bufs, 50)
+
+    def _is_hot(self, buf):
+        if buf.get('view') or self.get_view(buf['id']):
+            return True
+        sig = hash_cache.signature(utils.get_full_path(buf['path']))
+        return bool(sig and sig[1] > time.time() - self.RECENT_TIME)
+
+    def _hydrate(self, buf_id):
+        self.hydrate_pending.discard(buf_id)
+        self.hydrating.add(buf_id)
+        self.get_buf(buf_id)
+
+    def _trickle_bufs(self):
+        # Stay out of the way of everything else we're sending
+        if len(self.proto) > 0:
+            return
+        while len(self.hydrating) < self.HYDRATE_IN_FLIGHT and self.hydrate_queue:
+            buf_id = self.hydrate_queue.popleft()
+            if buf_id in self.hydrate_pending and buf_id in self.bufs:
+                self._hydrate(buf_id)
+        if not self.hydrate_queue:
+            self.hydrate_pending.clear()
+            utils.cancel_timeout(self.hydrate_timeout)
+            self.hydrate_timeout = None
 
     def save_view(self, view):
         view.save()
@@ -137,17 +274,82 @@ class FlooHandler(base.BaseHandler):
         return '{protocol}://{host}/{owner}/{name}'.format(protocol=protocol, host=self.proto.host, owner=self.owner, name=self.workspace)
 
     def reset(self):
-        self.bufs = {}
+        # Lets things that span many ticks (like joining) notice that they're stale
+        self.connection_id += 1
+        if self.bufs is not None:
+            msg.debug('Buffer store: ', self.bufs.stats())
+            self.bufs.clear_spilled()
+        self.bufs = buf_store.BufStore(G.MAX_BUF_MEMORY, os.path.join(G.BASE_DIR, 'buf_cache'), self._can_evict, self.hash_cache)
         self.paths_to_ids = {}
         self.save_on_get_bufs = set()
+        # Buf id -> md5 we last synced, for get_buf replies that get patched to match the file on disk.
+        # See _send_local_changes().
+        self.patch_on_get_bufs = {}
+        # Bufs fetched again because their base64 didn't match their md5
+        self.b64_refetched = set()
         self.on_load = collections.defaultdict(dict)
         utils.cancel_timeout(self.upload_timeout)
         self.upload_timeout = None
+        self.upload_pacer = None
+        self.upload_queue.clear()
+        if self.upload_manifest:
+            self.upload_manifest.save()
+        self._cancel_scan()
+        # Bufs waiting to be fetched by the background trickle, in order
+        self.hydrate_queue = collections.deque()
+        self.hydrate_pending = set()
+        # Bufs we sent get_buf for and haven't heard back about
+        self.hydrating = set()
+        utils.cancel_timeout(self.hydrate_timeout)
+        self.hydrate_timeout = None
+        # Buf id -> patches received this tick
+        self.pending_patches = {}
+        utils.cancel_timeout(self.patch_flush_timeout)
+        self.patch_flush_timeout = None
+        # Bufs we couldn't patch while _on_room_info was still comparing files. None when not joining.
+        self.patched_while_joining = None
+
+    def on_data(self, name, data):
+        # Anything else could depend on patches we haven't applied yet
+        if name != 'patch' and self.pending_patches:
+            self.flush_patches()
+        if self.upload_pacer:
+            self.upload_pacer.on_ack(data.get('res_id'))
+        return super(FlooHandler, self).on_data(name, data)
 
     def _on_patch(self, data):
-        buf_id = data['id']
-        buf = self.bufs[buf_id]
-        if 'buf' not in buf:
+        # Patches that arrive in the same tick get applied together by flush_patches()
+        patches = self.pending_patches.get(data['id'])
+        if patches is None:
+            self.pending_patches[data['id']] = [data]
+        else:
+            patches.append(data)
+        if self.patch_flush_timeout is None:
+            self.patch_flush_timeout = utils.set_timeout(self.flush_patches, 0)
+
+    def flush_patches(self):
+        utils.cancel_timeout(self.patch_flush_timeout)
+        self.patch_flush_timeout = None
+        pending = self.pending_patches
+        self.pending_patches = {}
+        for buf_id, patches in pending.items():
+            self._apply_patches(buf_id, patches)
+
+    def _apply_patches(self, buf_id, patches):
+        joining = self.patched_while_joining
+        if joining is not None and buf_id in joining:
+            # Already missed some. It gets fetched once we've joined.
+            return
+        buf = self.bufs.get(buf_id)
+        loaded = buf is not None and self.load_buf(buf)
+        if not loaded and joining is not None:
+            # Our copy is from room_info and the scan hasn't gotten to it. Fetch it once we've joined.
+            msg.debug('Joining. Fetching buf ', buf_id, ' after ', len(patches), ' patches.')
+            joining.add(buf_id)
+            return
+        if buf is None:
+            return msg.warn('no buf found for patch ', buf_id, '. Hopefully you didn\'t need that.')
+        if not loaded:
             msg.debug('buf ', buf['path'], ' not populated yet. not patching')
             return
 
@@ -155,12 +357,15 @@ class FlooHandler(base.BaseHandler):
             # TODO apply binary patches
             return self.get_buf(buf_id, None)
 
-        if len(data['patch']) == 0:
+        if buf.get('resync_md5'):
+            msg.debug('Resyncing ', buf['path'], '. Ignoring ', len(patches), ' patches.')
+            return
+
+        patches = [p for p in patches if len(p['patch'])]
+        if not patches:
             msg.debug('wtf? no patches to apply. server is being stupid')
             return
 
-        msg.debug('patch is', data['patch'])
-        dmp_patches = DMP.patch_fromText(data['patch'])
         # TODO: run this in a separate thread
         old_text = buf['buf']
 
@@ -181,31 +386,39 @@ class FlooHandler(base.BaseHandler):
             else:
                 msg.debug('forced patch is true. not sending another force patch for buf ', buf['path'])
 
+        # Only the ends of the batch get checked. If anything in the middle went wrong, md5_after won't match.
         md5_before = hashlib.md5(old_text.encode('utf-8')).hexdigest()
-        if md5_before != data['md5_before']:
+        if md5_before != patches[0]['md5_before']:
             msg.warn('starting md5s don\'t match for ', buf['path'], '. this is dangerous!')
 
-        t = DMP.patch_apply(dmp_patches, old_text)
-
+        text = old_text
+        # (offset, length, text) for every hunk, in the order they have to be applied to the view
+        hunks = []
+        # Who wrote each hunk, so the view can highlight them in the right colours
+        usernames = []
         clean_patch = True
-        for applied_patch in t[1]:
-            if not applied_patch:
+        for data in patches:
+            msg.debug('patch is', data['patch'])
+            t = DMP.patch_apply(DMP.patch_fromText(data['patch']), text)
+            if not all(t[1]):
                 clean_patch = False
                 break
-
-        if G.DEBUG:
-            if len(t[0]) == 0:
-                try:
-                    msg.debug('OMG EMPTY!')
-                    msg.debug('Starting data:', buf['buf'])
+            if G.DEBUG:
+                if len(t[0]) == 0:
+                    try:
+                        msg.debug('OMG EMPTY!')
+                        msg.debug('Starting data:', text)
+                        msg.debug('Patch:', data['patch'])
+                    except Exception as e:
+                        msg.error(e)
+
+                if '\x01' in t[0]:
+                    msg.debug('FOUND CRAZY BYTE IN BUFFER')
+                    msg.debug('Starting data:', text)
                     msg.debug('Patch:', data['patch'])
-                except Exception as e:
-                    msg.error(e)
-
-            if '\x01' in t[0]:
-                msg.debug('FOUND CRAZY BYTE IN BUFFER')
-                msg.debug('Starting data:', buf['buf'])
-                msg.debug('Patch:', data['patch'])
+            text = t[0]
+            hunks.extend(t[2])
+            usernames.extend([data.get('username')] * len(t[2]))
 
         timeout_id = buf.get('timeout_id')
         if timeout_id:
@@ -214,27 +427,31 @@ class FlooHandler(base.BaseHandler):
 
         if not clean_patch:
             msg.log('Couldn\'t patch ', buf['path'], ' cleanly.')
-            return self.get_buf(buf_id, view)
+            return self.resync_buf(buf_id, view)
 
-        cur_hash = hashlib.md5(t[0].encode('utf-8')).hexdigest()
-        if cur_hash != data['md5_after']:
+        if len(patches) > 1:
+            msg.debug('Applying ', len(patches), ' patches to ', buf['path'], ' at once')
+
+        cur_hash = hashlib.md5(text.encode('utf-8')).hexdigest()
+        if cur_hash != patches[-1]['md5_after']:
             msg.debug('Ending md5s don\'t match for ', buf['path'], ' Setting get_buf timeout.')
-            buf['timeout_id'] = utils.set_timeout(self.get_buf, 2000, buf_id, view)
+            buf['timeout_id'] = utils.set_timeout(self.resync_buf, 2000, buf_id, view)
 
-        buf['buf'] = t[0]
+        buf['buf'] = text
         buf['md5'] = cur_hash
+        self.bufs.touch(buf_id)
 
         if not view:
             msg.debug('No view. Not saving buffer ', buf_id)
 
             def _on_load():
                 v = self.get_view(buf_id)
-                if v and 'buf' in buf:
+                if v and self.load_buf(buf):
                     v.update(buf, message=False)
             self.on_load[buf_id]['patch'] = _on_load
             return
 
-        view.apply_patches(buf, t, data['username'])
+        view.apply_patches(buf, (text, [True] * len(hunks), hunks), patches[-1]['username'], usernames)
 
     def _on_get_buf(self, data):
         buf_id = data['id']
@@ -245,36 +462,191 @@ class FlooHandler(base.BaseHandler):
         if timeout_id:
             utils.cancel_timeout(timeout_id)
 
-        if data['encoding'] == 'base64':
-            data['buf'] = base64.b64decode(data['buf'])
-
-        self.bufs[buf_id] = data
-
         save = False
         if buf_id in self.save_on_get_bufs:
             self.save_on_get_bufs.remove(buf_id)
             save = True
 
+        if 'patch' in data:
+            return self._on_resync_patch(buf, data, save)
+
+        if buf_id in self.patch_on_get_bufs:
+            synced_md5 = self.patch_on_get_bufs.pop(buf_id)
+            # Unless somebody asked for the workspace's copy since
+            if not save and self._patch_to_local(data, synced_md5):
+                return
+
+        b64 = None
+        if data['encoding'] == 'base64':
+            # Decoded once we know whether it's open. If it's not, it goes straight to disk.
+            b64 = data.pop('buf')
+        self.bufs[buf_id] = data
+        self.hydrating.discard(buf_id)
+
         view = self.get_view(buf_id)
+        if b64 is not None:
+            if not view and self._save_b64_buf(data, b64, save):
+                return
+            data['buf'] = base64.b64decode(b64)
+            self.bufs.touch(buf_id)
+
         if not view:
             msg.debug('No view for buf ', buf_id, '. Saving to disk.')
-            return utils.save_buf(data)
+            if utils.save_buf(data) and G.LAZY_HYDRATION:
+                # It's on disk now. load_buf() can read it back if we need it.
+                del data['buf']
+                data['unloaded'] = True
+                self.bufs.touch(buf_id)
+            return
 
         view.update(data)
         if save:
             view.save()
 
-    def _on_create_buf(self, data):
+    def _send_local_changes(self, buf):
+        """ The file changed on disk while buf was unloaded. Make the workspace match it, unless
+        the workspace changed too. """
+        # We don't have the text buf['md5'] is for. Fetch it, then see who changed what.
+        self.patch_on_get_bufs[buf['id']] = buf['md5']
+        self.get_buf(buf['id'])
+
+    def _patch_to_local(self, data, synced_md5):
+        """ Reply to _send_local_changes(): data is the workspace's copy. If it's still the version
+        we last synced, send the file on disk. If not, both changed and we ask which one to keep.
+        Returns False if the file couldn't be read, in which case data should be handled like any
+        other get_buf. """
+        buf_id = data['id']
+        try:
+            local, md5 = self._read_buf(data)
+        except Exception as e:
+            msg.debug('Error reading ', data['path'], ': ', str_e(e))
+            return False
         if data['encoding'] == 'base64':
             data['buf'] = base64.b64decode(data['buf'])
+        self.bufs[buf_id] = data
+        self.hydrating.discard(buf_id)
+        self.bufs.touch(buf_id)
+        if md5 == data['md5']:
+            return True
+        if data['md5'] != synced_md5:
+            msg.log(data['path'], ' changed on disk and in the workspace.')
+            self._prompt_local_changes(data)
+            return True
+        if data['encoding'] != 'utf8':
+            # No binary patches. Send the whole file.
+            self._upload(utils.get_full_path(data['path']))
+            return True
+        patch = utils.FlooPatch(local, data)
+        patch_json = patch.to_json()
+        data['buf'] = local
+        data['md5'] = patch.md5_after
+        self.bufs.touch(buf_id)
+        if patch_json:
+            msg.log('Patching ', data['path'], ' to match the file on disk.')
+            self.send(patch_json)
+        return True
+
+    @utils.inlined_callbacks
+    def _prompt_local_changes(self, buf):
+        """ Same prompt as joining with local changes, for just buf. Until it's answered, buf
+        holds the workspace's copy and the file on disk is left alone. """
+        stomp_local = yield self.stomp_prompt, [buf], [], [], []
+        if stomp_local not in [0, 1] or self.bufs.get(buf['id']) is not buf:
+            return
+        if stomp_local:
+            self._stomp_local([buf])
+        else:
+            self._upload(utils.get_full_path(buf['path']))
+
+    def _on_resync_patch(self, buf, data, save):
+        """ Reply to resync_buf(): a patch from resync_md5 to what the server has. """
+        buf_id = buf['id']
+        buf.pop('timeout_id', None)
+        view = self.get_view(buf_id)
+        md5_before = buf.pop('resync_md5', None)
+        text = buf.get('buf')
+        if text is None or md5_before != data.get('md5_before'):
+            msg.debug('Resync patch for ', buf['path'], ' doesn\'t start from what we have.')
+            return self.get_buf(buf_id, view)
+
+        t = DMP.patch_apply(DMP.patch_fromText(data['patch']), text)
+        cur_hash = hashlib.md5(t[0].encode('utf-8')).hexdigest()
+        if not all(t[1]) or cur_hash != data.get('md5'):
+            msg.log('Couldn\'t resync ', buf['path'], ' with a patch. Getting the whole thing.')
+            if save:
+                self.save_on_get_bufs.add(buf_id)
+            return self.get_buf(buf_id, view)
+
+        msg.log('Floobits synced data for consistency: ', buf['path'])
+        buf['buf'] = t[0]
+        buf['md5'] = cur_hash
+        buf['forced_patch'] = False
+        self.bufs.touch(buf_id)
+
+        if not view:
+            utils.save_buf(buf)
+            return
+
+        view.set_read_only(False)
+        if view.get_text() == text:
+            view.apply_patches(buf, t, self.username)
+            view.erase_status()
+        else:
+            view.update(buf)
+        if save:
+            view.save()
+        if 'patch' not in G.PERMS:
+            view.set_status('You don\'t have write permission. Buffer is read-only.')
+            view.set_read_only(True)
+
+    def _on_create_buf(self, data):
+        b64 = None
+        if data['encoding'] == 'base64':
+            b64 = data.pop('buf')
         self.bufs[data['id']] = data
         self.paths_to_ids[data['path']] = data['id']
         view = self.get_view(data['id'])
+        if b64 is not None:
+            if not view and self._save_b64_buf(data, b64):
+                return
+            data['buf'] = base64.b64decode(b64)
+            self.bufs.touch(data['id'])
         if view:
             self.save_view(view)
         else:
             utils.save_buf(data)
 
+    def _save_b64_buf(self, buf, b64, save=False):
+        """ Decodes base64 contents straight to buf's file a chunk at a time, leaving buf unloaded.
+        If they don't match buf['md5'], the file is left alone and buf is fetched again (saved
+        when it arrives if save is set). Returns False if that didn't work. """
+        buf_id = buf['id']
+        path = utils.get_full_path(buf['path'])
+        try:
+            utils.mkdir(os.path.split(path)[0])
+            md5 = b64stream.decode_to_file(b64, path, buf.get('md5'))
+        except Exception as e:
+            msg.error('Error saving buf: ', str_e(e))
+            return False
+        if buf.get('md5') is not None and md5 != buf['md5']:
+            if buf_id in self.b64_refetched:
+                # Already tried that. Keep what we got like we used to.
+                self.b64_refetched.discard(buf_id)
+                msg.error('md5 for ', buf['path'], ' still doesn\'t match. Keeping it in memory.')
+                return False
+            msg.warn('md5 for ', buf['path'], ' doesn\'t match what we decoded.')
+            self.b64_refetched.add(buf_id)
+            if save:
+                self.save_on_get_bufs.add(buf_id)
+            self.get_buf(buf_id)
+            return True
+        self.b64_refetched.discard(buf_id)
+        buf['unloaded'] = True
+        if self.hash_cache:
+            self.hash_cache.set(buf['path'], hash_cache.signature(path), hash_cache.RAW, md5)
+        self.bufs.touch(buf_id)
+        return True
+
     def _on_rename_buf(self, data):
         del self.paths_to_ids[data['old_path']]
         self.paths_to_ids[data['path']] = data['id']
@@ -297,6 +669,8 @@ class FlooHandler(base.BaseHandler):
     def _on_delete_buf(self, data):
         buf_id = data['id']
         path = data.get('path')
+        self.hydrate_pending.discard(buf_id)
+        self.hydrating.discard(buf_id)
         try:
             buf = self.bufs.get(buf_id)
             if buf:
@@ -326,9 +700,7 @@ class FlooHandler(base.BaseHandler):
         files, size = yield self.prompt_ignore, ig, G.PROJECT_PATH
 
         missing_buf_ids = set([buf['id'] for buf in missing_bufs])
-        for buf_id in missing_buf_ids:
-            self.send({'name': 'delete_buf', 'id': buf_id})
-
+        delete_ids = list(missing_buf_ids)
         for p, buf_id in self.paths_to_ids.items():
             if p in files:
                 files.discard(p)
@@ -336,23 +708,7 @@ class FlooHandler(base.BaseHandler):
                 continue
             if buf_id in missing_buf_ids:
                 continue
-            self.send({
-                'name': 'delete_buf',
-                'id': buf_id,
-            })
-
-        def __upload(rel_path_or_buf):
-            # Its a buf!
-            if type(rel_path_or_buf) == dict:
-                return self._upload(utils.get_full_path(rel_path_or_buf['path']), rel_path_or_buf.get('buf'))
-
-            # Its a rel path!
-            buf_id = self.paths_to_ids.get(rel_path_or_buf)
-            text = self.bufs.get(buf_id, {}).get('buf')
-            # Only upload stuff that's not in self.bufs (new bufs). We already took care of everything else.
-            if text is not None:
-                return len(text)
-            return self._upload(utils.get_full_path(rel_path_or_buf), self.get_view_text_by_path(rel_path_or_buf))
+            delete_ids.append(buf_id)
 
         def make_iterator():
             # Upload changed bufs before everything else, since they're probably what people will edit
@@ -361,74 +717,206 @@ class FlooHandler(base.BaseHandler):
             for f in files:
                 yield f
 
+        # Write down what we're about to do so a reconnect can finish it
+        self.upload_manifest.add([b['path'] for b in changed_bufs] + list(files), [self.bufs[buf_id]['path'] for buf_id in delete_ids])
+        for buf_id in delete_ids:
+            self._delete_buf(buf_id)
+
         total_size = reduce(lambda a, buf: a + len(buf.get('buf', '')), changed_bufs, size)
-        self._rate_limited_upload(make_iterator(), total_size, upload_func=__upload)
+        self._rate_limited_upload(make_iterator(), total_size, upload_func=self._upload_item)
         cb()
 
-    def _scan_dir(self, bufs, ig, read_only):
+    def _resume_upload(self, changed_bufs, missing_bufs, new_files):
+        """ Finishes the upload in self.upload_manifest. Returns changed_bufs and missing_bufs
+        minus what that took care of. Resumed paths are removed from new_files. """
+        manifest = self.upload_manifest
+        msg.log('Resuming upload. ', len(manifest.pending), ' files and ', len(manifest.deletes), ' deletes left.')
+        changed = dict((b['path'], b) for b in changed_bufs)
+        items = []
+        total_size = 0
+        for path in list(manifest.pending.keys()):
+            buf = changed.pop(path, None)
+            if buf is not None:
+                items.append(buf)
+                total_size += len(buf.get('buf') or '')
+            elif path in new_files:
+                new_files.discard(path)
+                items.append(path)
+                try:
+                    total_size += os.path.getsize(utils.get_full_path(path))
+                except (IOError, OSError):
+                    pass
+            else:
+                # The server got it before we lost the connection, or it's not here anymore
+                manifest.ack(path)
+
+        missing = dict((b['path'], b) for b in missing_bufs)
+        for path in list(manifest.deletes):
+            buf_id = self.paths_to_ids.get(path)
+            missing.pop(path, None)
+            if buf_id is None:
+                manifest.ack(path)
+            else:
+                self._delete_buf(buf_id)
+
+        if items:
+            self._rate_limited_upload(iter(items), total_size, upload_func=self._upload_item)
+        return [b for b in changed_bufs if b['path'] in changed], [b for b in missing_bufs if b['path'] in missing]
+
+    def _delete_buf(self, buf_id):
+        path = self.bufs[buf_id]['path']
+        self.send({
+            'name': 'delete_buf',
+            'id': buf_id,
+        }, lambda data: self.upload_manifest.ack(path))
+
+    def _upload_item(self, rel_path_or_buf):
+        # Its a buf!
+        if type(rel_path_or_buf) == dict:
+            return self._upload(utils.get_full_path(rel_path_or_buf['path']), rel_path_or_buf.get('buf'))
+
+        # Its a rel path!
+        buf_id = self.paths_to_ids.get(rel_path_or_buf)
+        buf = self.bufs.get(buf_id, {})
+        text = buf.get('buf')
+        # Only upload stuff that's not in self.bufs (new bufs). We already took care of everything else.
+        if text is not None:
+            self.upload_manifest.ack(rel_path_or_buf)
+            return len(text)
+        if buf.get('unloaded') or buf.get('spilled'):
+            self.upload_manifest.ack(rel_path_or_buf)
+            return 0
+        return self._upload(utils.get_full_path(rel_path_or_buf), self.get_view_text_by_path(rel_path_or_buf))
+
+    @utils.inlined_callbacks
+    def _scan_dir(self, bufs, ig, read_only, cb):
+        """ Compares local files against bufs. Files are read and hashed on background threads.
+        Calls cb([changed_bufs, missing_bufs, new_files]) when done. """
         status_msg = 'Comparing local files against workspace...'
         editor.status_message(status_msg)
         update_status_msg = getattr(self, 'update_status_msg', None)
         if update_status_msg:
-            try:
-                update_status_msg(self, status_msg)
-            except Exception as e:
-                pass
+            update_status_msg(status_msg)
 
+        self._cancel_scan()
+        hasher = file_hasher.FileHasher(self.hash_cache)
+        self.scan_hasher = hasher
         changed_bufs = []
         missing_bufs = []
         new_files = set()
 
         if not read_only:
-            new_files = set([utils.to_rel_path(x) for x in ig.list_paths()])
+            yield utils.time_sliced, ig.list_paths(), lambda x: new_files.add(utils.to_rel_path(x))
+            if self.scan_hasher is not hasher:
+                return
+
+        # Results come back in whatever order they finish. Report them in the order we got them.
+        order = {}
 
-        for buf_id, buf in bufs.items():
+        def add_buf(item):
+            buf_id, buf = item
             buf_id = int(buf_id)  # json keys must be strings
             buf_path = utils.get_full_path(buf['path'])
+            order[buf_id] = len(order)
             view = self.get_view(buf_id)
             if view and not view.is_loading() and buf['encoding'] == 'utf8':
                 view_text = view.get_text()
                 view_md5 = hashlib.md5(view_text.encode('utf-8')).hexdigest()
                 buf['buf'] = view_text
                 buf['view'] = view
+                self.bufs.touch(buf_id)
                 G.VIEW_TO_HASH[view.native_id] = view_md5
                 if view_md5 == buf['md5']:
                     msg.debug('md5 sum matches view. not getting buffer ', buf['path'])
                 else:
                     changed_bufs.append(buf)
                     buf['md5'] = view_md5
-                continue
+                return
+            hasher.add(buf, buf_path)
 
-            try:
-                if buf['encoding'] == 'utf8':
-                    if io:
-                        buf_fd = io.open(buf_path, 'Urt', encoding='utf8')
-                        buf_buf = buf_fd.read()
-                    else:
-                        buf_fd = open(buf_path, 'rb')
-                        buf_buf = buf_fd.read().decode('utf-8').replace('\r\n', '\n')
-                    md5 = hashlib.md5(buf_buf.encode('utf-8')).hexdigest()
-                else:
-                    buf_fd = open(buf_path, 'rb')
-                    buf_buf = buf_fd.read()
-                    md5 = hashlib.md5(buf_buf).hexdigest()
-                buf_fd.close()
-                buf['buf'] = buf_buf
-                if md5 == buf['md5']:
-                    msg.debug('md5 sum matches. not getting buffer ', buf['path'])
-                else:
-                    msg.debug('md5 differs. possibly getting buffer later ', buf['path'])
-                    changed_bufs.append(buf)
-                    buf['md5'] = md5
-            except Exception as e:
-                msg.debug('Error calculating md5 for ', buf['path'], ', ', str_e(e))
+        yield utils.time_sliced, list(bufs.items()), add_buf
+        if self.scan_hasher is not hasher:
+            return
+
+        def on_result(buf, sig, buf_buf, md5, error):
+            if error:
+                msg.debug('Error calculating md5 for ', buf['path'], ', ', str_e(error))
                 missing_bufs.append(buf)
+                return
+            if self.hash_cache:
+                kind = buf['encoding'] == 'utf8' and hash_cache.TEXT or hash_cache.RAW
+                self.hash_cache.set(buf['path'], sig, kind, md5)
+            if buf_buf is not None and G.LAZY_HYDRATION and md5 == buf['md5']:
+                buf_buf = None
+            if buf_buf is None:
+                # Same as the workspace. Don't read it until we need it.
+                msg.debug('md5 sum matches. not loading buffer ', buf['path'])
+                if buf.get('buf') is None:
+                    buf['unloaded'] = True
+                return
+            buf['buf'] = buf_buf
+            self.bufs.touch(int(buf['id']))
+            if md5 == buf['md5']:
+                msg.debug('md5 sum matches. not getting buffer ', buf['path'])
+            else:
+                msg.debug('md5 differs. possibly getting buffer later ', buf['path'])
+                changed_bufs.append(buf)
+                buf['md5'] = md5
+
+        yield self._poll_scan, hasher, on_result, status_msg
+        self._cancel_scan()
+        if self.hash_cache:
+            self.hash_cache.save()
         editor.status_message('Comparing local files against workspace... done.')
-        return changed_bufs, missing_bufs, new_files
+        key = lambda b: order[int(b['id'])]
+        cb([sorted(changed_bufs, key=key), sorted(missing_bufs, key=key), new_files])
+
+    def _poll_scan(self, hasher, on_result, status_msg, cb):
+        update_status_msg = getattr(self, 'update_status_msg', None)
+
+        def poll():
+            results = hasher.poll()
+            for result in results:
+                on_result(*result)
+            if hasher.done():
+                utils.cancel_timeout(self.scan_timeout)
+                self.scan_timeout = None
+                cb()
+                return
+            if not results:
+                return
+            progress = '%s %s/%s' % (status_msg, hasher.finished, hasher.total)
+            editor.status_message(progress)
+            if update_status_msg:
+                update_status_msg(progress)
+
+        self.scan_timeout = utils.set_interval(poll, 20)
+
+    def _cancel_scan(self):
+        if self.scan_hasher:
+            self.scan_hasher.cancel()
+            self.scan_hasher = None
+        utils.cancel_timeout(self.scan_timeout)
+        self.scan_timeout = None
+
+    def _read_buf(self, buf):
+        ''' Returns (contents, md5) of buf's file on disk. Raises if it can't be read. '''
+        buf_path = utils.get_full_path(buf['path'])
+        # stat() before reading so a write that races with us invalidates the cache entry
+        sig = hash_cache.signature(buf_path)
+        buf_buf, md5 = file_hasher.read_buf(buf_path, buf['encoding'])
+        if self.hash_cache:
+            kind = buf['encoding'] == 'utf8' and hash_cache.TEXT or hash_cache.RAW
+            self.hash_cache.set(buf['path'], sig, kind, md5)
+        return buf_buf, md5
 
     @utils.inlined_callbacks
     def _on_room_info(self, data):
+        connection_id = self.connection_id
+        stages = utils.StageTimer('Joining workspace')
+        stages.stage('checking permissions')
         self.joined_workspace = True
+        self.patched_while_joining = set()
         self.workspace_info = data
         G.PERMS = data['perms']
 
@@ -453,6 +941,7 @@ class FlooHandler(base.BaseHandler):
                 else:
                     editor.error_message(no_perms_msg)
 
+        stages.stage('saving workspace info')
         floo_json = {
             'url': utils.to_workspace_url({
                 'owner': self.owner,
@@ -464,22 +953,50 @@ class FlooHandler(base.BaseHandler):
         }
         utils.update_floo_file(os.path.join(G.PROJECT_PATH, '.floo'), floo_json)
         utils.update_recent_workspaces(self.workspace_url)
+        self.hash_cache = hash_cache.HashCache(self.workspace_url, G.PROJECT_PATH)
+        self.bufs.cache = self.hash_cache
+        self.upload_manifest = upload_manifest.UploadManifest(self.workspace_url, G.PROJECT_PATH)
+        if self.action == utils.JOIN_ACTION.UPLOAD:
+            # Starting over
+            self.upload_manifest.clear()
 
-        ig = ignore.create_ignore_tree(G.PROJECT_PATH)
-        G.IGNORE = ig
-        for buf_id, buf in data['bufs'].items():
+        stages.stage('loading buffers')
+
+        def add_buf(item):
+            buf_id, buf = item
             buf_id = int(buf_id)  # json keys must be strings
             self.bufs[buf_id] = buf
             self.paths_to_ids[buf['path']] = buf_id
-        changed_bufs, missing_bufs, new_files = self._scan_dir(data['bufs'], ig, read_only)
+        yield utils.time_sliced, list(data['bufs'].items()), add_buf
+        if connection_id != self.connection_id:
+            return
 
+        stages.stage('finding files')
+        ig = yield ignore.create_ignore_tree_async, G.PROJECT_PATH
+        if connection_id != self.connection_id:
+            return
+        G.IGNORE = ig
+
+        stages.stage('comparing files')
+        changed_bufs, missing_bufs, new_files = yield self._scan_dir, data['bufs'], ig, read_only
+
+        stages.stage('finding ignored files')
         ignored = []
-        for p, buf_id in self.paths_to_ids.items():
+
+        def find_ignored(p):
             if p not in new_files:
                 ignored.append(p)
             new_files.discard(p)
+        yield utils.time_sliced, list(self.paths_to_ids.keys()), find_ignored
+        if connection_id != self.connection_id:
+            return
+
+        if self.upload_manifest and not read_only:
+            stages.stage('resuming upload')
+            changed_bufs, missing_bufs = self._resume_upload(changed_bufs, missing_bufs, new_files)
 
         if self.action == utils.JOIN_ACTION.UPLOAD:
+            stages.stage('uploading')
             yield self._initial_upload, ig, missing_bufs, changed_bufs
             # TODO: maybe use org name here
             who = 'Your friends'
@@ -494,6 +1011,7 @@ class FlooHandler(base.BaseHandler):
         elif changed_bufs or missing_bufs or new_files:
             # TODO: handle readonly here
             if self.action == utils.JOIN_ACTION.PROMPT:
+                stages.stage('waiting for you')
                 stomp_local = yield self.stomp_prompt, changed_bufs, missing_bufs, list(new_files), ignored
                 if stomp_local not in [0, 1]:
                     self.stop()
@@ -506,18 +1024,16 @@ class FlooHandler(base.BaseHandler):
                 return
 
             if stomp_local:
-                for buf in changed_bufs:
-                    self.get_buf(buf['id'], buf.get('view'))
-                    self.save_on_get_bufs.add(buf['id'])
-                for buf in missing_bufs:
-                    self.get_buf(buf['id'], buf.get('view'))
-                    self.save_on_get_bufs.add(buf['id'])
+                stages.stage('requesting buffers')
+                self._stomp_local(changed_bufs + missing_bufs)
             else:
+                stages.stage('uploading')
                 yield self._initial_upload, ig, missing_bufs, changed_bufs
 
+        stages.stage('finishing')
+        self._fetch_patched_while_joining(changed_bufs + missing_bufs)
         success_msg = '%s@%s/%s: Joined!' % (self.username, self.owner, self.workspace)
         msg.log(success_msg)
-        editor.status_message(success_msg)
 
         data = utils.get_persistent_data()
         data['recent_workspaces'].insert(0, {"url": self.workspace_url})
@@ -542,14 +1058,28 @@ class FlooHandler(base.BaseHandler):
                     'data': repo_info,
                 })
 
+        stages.done()
+        editor.status_message(success_msg)
         self.emit("room_info")
 
+    def _fetch_patched_while_joining(self, handled_bufs):
+        """ Gets the bufs whose patches we dropped while joining. handled_bufs were fetched or
+        uploaded already, depending on what the user picked. """
+        buf_ids = self.patched_while_joining or set()
+        self.patched_while_joining = None
+        buf_ids = buf_ids.difference([buf['id'] for buf in handled_bufs])
+        if buf_ids:
+            msg.log('Fetching ', len(buf_ids), ' buffers that changed while joining.')
+        for buf_id in buf_ids:
+            if buf_id in self.bufs:
+                self.get_buf(buf_id, self.get_view(buf_id))
+
     @utils.inlined_callbacks
     def refresh_workspace(self):
-        ig = ignore.create_ignore_tree(G.PROJECT_PATH)
+        ig = yield ignore.create_ignore_tree_async, G.PROJECT_PATH
         G.IGNORE = ig
         read_only = 'patch' not in self.workspace_info['perms']
-        changed_bufs, missing_bufs, new_files = self._scan_dir(self.bufs, G.IGNORE, read_only)
+        changed_bufs, missing_bufs, new_files = yield self._scan_dir, self.bufs, G.IGNORE, read_only
         ignored = []
         for p, buf_id in self.paths_to_ids.items():
             if p not in new_files:
@@ -560,12 +1090,7 @@ class FlooHandler(base.BaseHandler):
             if stomp_local not in [0, 1]:
                 return
             if stomp_local:
-                for buf in changed_bufs:
-                    self.get_buf(buf['id'], buf.get('view'))
-                    self.save_on_get_bufs.add(buf['id'])
-                for buf in missing_bufs:
-                    self.get_buf(buf['id'], buf.get('view'))
-                    self.save_on_get_bufs.add(buf['id'])
+                self._stomp_local(changed_bufs + missing_bufs)
             else:
                 yield self._initial_upload, G.IGNORE, missing_bufs, changed_bufs
         else:
@@ -612,7 +1137,7 @@ class FlooHandler(base.BaseHandler):
         view = self.get_view(data['id'])
         if view:
             self.save_view(view)
-        elif 'buf' in buf:
+        elif ('buf' in buf or buf.get('spilled')) and self.load_buf(buf):
             utils.save_buf(buf)
         username = self.get_username_by_id(data['user_id'])
         msg.log('%s saved buffer %s' % (username, buf['path']))
@@ -701,11 +1226,12 @@ class FlooHandler(base.BaseHandler):
             files = files.union(set([utils.to_rel_path(x) for x in ig.files]))
         cb([files, size])
 
+    @utils.inlined_callbacks
     def upload(self, path):
         if not utils.is_shared(path):
             editor.error_message('Cannot share %s because is not in shared path %s.\n\nPlease move it there and try again.' % (path, G.PROJECT_PATH))
             return
-        ig = ignore.create_ignore_tree(G.PROJECT_PATH)
+        ig = yield ignore.create_ignore_tree_async, G.PROJECT_PATH
         G.IGNORE = ig
         is_dir = os.path.isdir(path)
         if ig.is_ignored(path, is_dir, True):
@@ -728,35 +1254,93 @@ class FlooHandler(base.BaseHandler):
         self._rate_limited_upload(ig.list_paths(), ig.total_size, upload_func=self._upload_file_by_path)
 
     def _rate_limited_upload(self, paths_iter, total_bytes, bytes_uploaded=0.0, upload_func=None):
-        reactor.tick()
         upload_func = upload_func or (lambda x: self._upload(utils.get_full_path(x)))
-        if len(self.proto) > 0:
-            self.upload_timeout = utils.set_timeout(self._rate_limited_upload, 10, paths_iter, total_bytes, bytes_uploaded, upload_func)
+        self.upload_queue.append((paths_iter, upload_func))
+        if self.upload_pacer:
+            # Already uploading. One loop sends everything so stop() and reset() can cancel it.
+            self.upload_pacer.total_bytes += total_bytes
+            self.upload_pacer.bytes_uploaded += bytes_uploaded
             return
+        self.upload_pacer = upload_pacer.UploadPacer(self.proto, total_bytes, bytes_uploaded)
+        self._paced_upload(self.upload_pacer)
 
-        bar_len = 20
-        try:
-            p = next(paths_iter)
-            size = upload_func(p)
-            bytes_uploaded += size
-            try:
-                percent = (bytes_uploaded / total_bytes)
-            except ZeroDivisionError:
-                percent = 0.5
-            bar = '   |' + ('|' * int(bar_len * percent)) + (' ' * int((1 - percent) * bar_len)) + '|'
-            editor.status_message('Uploading... %2.2f%% %s' % (percent * 100, bar))
-        except StopIteration:
-            editor.status_message('Uploading... 100% ' + ('|' * bar_len) + '| complete')
-            msg.log('All done uploading')
+    def _paced_upload(self, pacer):
+        reactor.tick()
+        if pacer is not self.upload_pacer:
+            # Stopped or reset while we were ticking
+            return
+        if not pacer.ready():
+            self.upload_timeout = utils.set_timeout(self._paced_upload, 10, pacer)
             return
-        self.upload_timeout = utils.set_timeout(self._rate_limited_upload, 50, paths_iter, total_bytes, bytes_uploaded, upload_func)
+
+        # Upload files until we hit the pacer's byte budget or use up our time slice
+        budget = pacer.batch_size()
+        req_id = self.proto.req_id
+        start = time.time()
+        size = 0
+        while size < budget and time.time() - start < utils.SLICE_TIME:
+            if not self.upload_queue:
+                pacer.sent(size)
+                editor.status_message('Uploading... 100% ' + ('|' * 20) + '| complete')
+                msg.log('All done uploading. ', pacer.summary(), ' ', self.blob_cache.stats())
+                self.upload_pacer = None
+                self.blob_cache.clear()
+                if self.hash_cache:
+                    self.hash_cache.save()
+                return
+            paths_iter, upload_func = self.upload_queue[0]
+            try:
+                path = next(paths_iter)
+            except StopIteration:
+                self.upload_queue.popleft()
+                continue
+            size += upload_func(path)
+        pacer.sent(size, self.proto.req_id != req_id and self.proto.req_id or None)
+        editor.status_message(pacer.status())
+        self.upload_timeout = utils.set_timeout(self._paced_upload, 10, pacer)
 
     def _upload(self, path, text=None):
         size = 0
+        sig = None
+        rel_path = None
         try:
+            rel_path = utils.to_rel_path(path)
+            existing_buf = self.get_buf_by_path(path)
+            blob = None
             if text is None:
-                with open(path, 'rb') as buf_fd:
-                    buf = buf_fd.read()
+                sig = hash_cache.signature(path)
+                buf_md5 = sig and self.hash_cache and self.hash_cache.get(rel_path, sig, hash_cache.RAW)
+                if buf_md5 and existing_buf and existing_buf['md5'] == buf_md5:
+                    msg.log(path, ' already exists and has the same md5. Skipping.')
+                    self.upload_manifest.ack(rel_path)
+                    return sig[0]
+                # We've already sent something identical. No need to read it again.
+                blob = buf_md5 and self.blob_cache.get(buf_md5)
+                if blob:
+                    size = sig[0]
+                elif sig and sig[0] >= b64stream.STREAM_SIZE:
+                    size, buf_md5, utf8 = b64stream.scan(path)
+                    if self.hash_cache:
+                        self.hash_cache.set(rel_path, sig, hash_cache.RAW, buf_md5)
+                    if utf8:
+                        with open(path, 'rb') as buf_fd:
+                            buf = buf_fd.read()
+                    else:
+                        # Encoded as it goes out. Nothing bigger than a chunk is kept in memory.
+                        blob = (b64stream.Base64File(path, size), 'base64')
+                else:
+                    with open(path, 'rb') as buf_fd:
+                        buf = buf_fd.read()
+                    size = len(buf)
+                    buf_md5 = hashlib.md5(buf).hexdigest()
+                    if self.hash_cache:
+                        self.hash_cache.set(rel_path, sig, hash_cache.RAW, buf_md5)
+                if existing_buf:
+                    if existing_buf['md5'] == buf_md5:
+                        msg.log(path, ' already exists and has the same md5. Skipping.')
+                        self.upload_manifest.ack(rel_path)
+                        return size
+                    existing_buf['md5'] = buf_md5
             else:
                 try:
                     # work around python 3 encoding issue
@@ -765,27 +1349,26 @@ class FlooHandler(base.BaseHandler):
                     msg.debug('Error encoding buf ', path, ': ', str_e(e))
                     # We're probably in python 2 so it's ok to do this
                     buf = text
-            size = len(buf)
-            encoding = 'utf8'
-            rel_path = utils.to_rel_path(path)
-            existing_buf = self.get_buf_by_path(path)
-            if existing_buf:
-                if text is None:
-                    buf_md5 = hashlib.md5(buf).hexdigest()
-                    if existing_buf['md5'] == buf_md5:
-                        msg.log(path, ' already exists and has the same md5. Skipping.')
-                        return size
-                    existing_buf['md5'] = buf_md5
-                msg.log('Setting buffer ', rel_path)
+                size = len(buf)
+                buf_md5 = hashlib.md5(buf).hexdigest()
+            if not blob:
+                blob = self._encode_blob(buf, buf_md5)
+            buf, encoding = blob
 
-                try:
-                    buf = buf.decode('utf-8')
-                except Exception:
-                    buf = base64.b64encode(buf).decode('utf-8')
-                    encoding = 'base64'
+            streamed = isinstance(buf, b64stream.Base64File)
 
-                existing_buf['buf'] = buf
+            if existing_buf:
+                msg.log('Setting buffer ', rel_path)
                 existing_buf['encoding'] = encoding
+                existing_buf.pop('spilled', None)
+                if streamed:
+                    # It's on disk. load_buf() can read it back if we need it.
+                    existing_buf.pop('buf', None)
+                    existing_buf['unloaded'] = True
+                else:
+                    existing_buf['buf'] = buf
+                    existing_buf.pop('unloaded', None)
+                self.bufs.touch(existing_buf['id'])
 
                 self.send({
                     'name': 'set_buf',
@@ -793,16 +1376,10 @@ class FlooHandler(base.BaseHandler):
                     'buf': buf,
                     'md5': existing_buf['md5'],
                     'encoding': encoding,
-                })
+                }, lambda d: self.upload_manifest.ack(rel_path))
                 self.send({'name': 'saved', 'id': existing_buf['id']})
                 return size
 
-            try:
-                buf = buf.decode('utf-8')
-            except Exception:
-                buf = base64.b64encode(buf).decode('utf-8')
-                encoding = 'base64'
-
             msg.log('Creating buffer ', rel_path, ' (', len(buf), ' bytes)')
             event = {
                 'name': 'create_buf',
@@ -813,16 +1390,42 @@ class FlooHandler(base.BaseHandler):
 
             def done(d):
                 if d.get('id'):
-                    self.bufs[d['id']] = buf
+                    new_buf = {
+                        'id': d['id'],
+                        'path': rel_path,
+                        'encoding': encoding,
+                        'md5': buf_md5,
+                    }
+                    if text is None:
+                        # It's on disk. load_buf() can read it back if we need it.
+                        new_buf['unloaded'] = True
+                    else:
+                        new_buf['buf'] = text
+                    self.bufs[d['id']] = new_buf
                     self.paths_to_ids[rel_path] = d['id']
+                self.upload_manifest.ack(rel_path)
 
             self.send(event, done)
         except (IOError, OSError):
             msg.error('Failed to open ', path)
+            # Nothing to resume
+            self.upload_manifest.ack(rel_path)
         except Exception as e:
             msg.error('Failed to create buffer ', path, ': ', str_e(e))
         return size
 
+    def _encode_blob(self, buf, buf_md5):
+        """ Returns (buf, encoding) to send for file contents buf. Identical contents are only encoded once. """
+        blob = self.blob_cache.get(buf_md5)
+        if blob:
+            return blob
+        try:
+            blob = (buf.decode('utf-8'), 'utf8')
+        except Exception:
+            blob = (base64.b64encode(buf).decode('utf-8'), 'base64')
+        self.blob_cache.set(buf_md5, *blob)
+        return blob
+
     def kick(self, user_id):
         if 'kick' not in G.PERMS:
             return
@@ -834,5 +1437,18 @@ class FlooHandler(base.BaseHandler):
     def stop(self):
         utils.cancel_timeout(self.upload_timeout)
         self.upload_timeout = None
+        self.upload_pacer = None
+        self.upload_queue.clear()
+        if self.upload_manifest:
+            self.upload_manifest.save()
+        self._cancel_scan()
+        utils.cancel_timeout(self.hydrate_timeout)
+        self.hydrate_timeout = None
+        utils.cancel_timeout(self.patch_flush_timeout)
+        self.patch_flush_timeout = None
+        self.pending_patches = {}
+        if self.hash_cache:
+            self.hash_cache.save()
+        self.bufs.clear_spilled()
 
         super(FlooHandler, self).stop()
@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import hashlib
+
+try:
+    from . import msg, shared as G, utils
+    from .exc_fmt import str_e
+    assert utils
+except ImportError:
+    import msg
+    import shared as G
+    import utils
+    from exc_fmt import str_e
+
+CACHE_DIR = 'hash_cache'
+# Forget workspaces that haven't been joined in this long
+MAX_AGE = 60 * 60 * 24 * 30
+MAX_WORKSPACES = 50
+# A file modified this recently can change again without its mtime changing, so don't trust it
+RACY_TIME = 2
+
+# Which md5 to look up. Text is what _scan_dir hashes (decoded, \r\n -> \n). Raw is the bytes on disk.
+TEXT = 3
+RAW = 4
+
+
+def signature(path):
+    ''' Returns [size, mtime, inode] for path, or None if it can't be stat()ed. '''
+    try:
+        s = os.stat(path)
+    except (IOError, OSError):
+        return None
+    return [s.st_size, s.st_mtime, s.st_ino]
+
+
+class HashCache(object):
+    ''' Remembers md5s of workspace files across sessions.
+
+    Entries are [size, mtime, inode, text md5, raw md5], keyed by relative path.
+    An entry is only used while the file's signature is unchanged. Each
+    workspace + local path gets its own file in G.BASE_DIR/hash_cache.
+    '''
+    VERSION = 1
+
+    def __init__(self, workspace_url, project_path):
+        self.key = '%s\n%s' % (workspace_url, project_path)
+        name = hashlib.md5(self.key.encode('utf-8')).hexdigest()
+        self.dir = os.path.join(G.BASE_DIR, CACHE_DIR)
+        self.path = os.path.join(self.dir, name + '.json')
+        self.files = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def get(self, rel_path, sig, kind):
+        entry = self.files.get(rel_path)
+        if sig and entry and entry[:3] == sig and entry[kind]:
+            self.hits += 1
+            return entry[kind]
+        self.misses += 1
+        return None
+
+    def set(self, rel_path, sig, kind, md5):
+        if not sig:
+            return
+        entry = self.files.get(rel_path)
+        if sig[1] > time.time() - RACY_TIME:
+            if entry:
+                del self.files[rel_path]
+                self.dirty = True
+            return
+        if not entry or entry[:3] != sig:
+            entry = sig + [None, None]
+            self.files[rel_path] = entry
+        if entry[kind] != md5:
+            entry[kind] = md5
+            self.dirty = True
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as fd:
+                data = json.loads(fd.read().decode('utf-8'))
+        except (IOError, OSError):
+            return
+        except Exception as e:
+            msg.debug('Error reading hash cache ', self.path, ': ', str_e(e))
+            return
+        if data.get('version') != self.VERSION or data.get('key') != self.key:
+            return
+        self.files = data.get('files', {})
+        msg.debug('Loaded ', len(self.files), ' hashes from ', self.path)
+
+    def save(self):
+        if not self.dirty:
+            return
+        data = {
+            'version': self.VERSION,
+            'key': self.key,
+            'files': self.files,
+        }
+        tmp_path = self.path + '.tmp'
+        try:
+            utils.mkdir(self.dir)
+            with open(tmp_path, 'wb') as fd:
+                fd.write(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+            if os.path.exists(self.path):
+                # Windows won't rename over an existing file
+                os.remove(self.path)
+            os.rename(tmp_path, self.path)
+        except Exception as e:
+            msg.error('Error writing hash cache ', self.path, ': ', str_e(e))
+            return
+        self.dirty = False
+        msg.debug('Hash cache: ', self.hits, ' hits, ', self.misses, ' misses. Saved ', len(self.files), ' hashes.')
+        self.evict()
+
+    def evict(self):
+        ''' Deletes caches for workspaces that haven't been saved in a while. '''
+        try:
+            names = os.listdir(self.dir)
+        except (IOError, OSError):
+            return
+        caches = []
+        for name in names:
+            path = os.path.join(self.dir, name)
+            try:
+                caches.append((os.stat(path).st_mtime, path))
+            except (IOError, OSError):
+                pass
+        caches.sort(reverse=True)
+        oldest = time.time() - MAX_AGE
+        for i, (mtime, path) in enumerate(caches):
+            if i < MAX_WORKSPACES and mtime > oldest:
+                continue
+            msg.debug('Removing stale hash cache ', path)
+            try:
+                os.remove(path)
+            except (IOError, OSError) as e:
+                msg.debug('Error removing ', path, ': ', str_e(e))
@@ -1,8 +1,16 @@
 import os
 import errno
 import fnmatch
+import re
 import stat
 import subprocess
+import threading
+
+try:
+    import queue
+    assert queue
+except ImportError:
+    import Queue as queue
 
 try:
     from . import msg, utils
@@ -10,8 +18,15 @@ try:
     assert msg and str_e and utils
 except ImportError:
     import msg
+    import utils
     from exc_fmt import str_e
 
+try:
+    scandir = os.scandir
+except AttributeError:
+    # Python < 3.5
+    scandir = None
+
 IGNORE_FILES = ['.gitignore', '.hgignore', '.ignore', '.flooignore']
 HIDDEN_WHITELIST = ['.floo'] + IGNORE_FILES
 BLACKLIST = [
@@ -68,17 +83,163 @@ def create_flooignore(path):
         msg.error('Error creating default .flooignore: ', str_e(e))
 
 
-def create_ignore_tree(path):
+def _create_root(path):
     create_flooignore(path)
     ig = Ignore(path)
     global_ignore = get_git_excludesfile()
     if global_ignore:
         ig.load(global_ignore)
     ig.ignores['/DEFAULT/'] = BLACKLIST
+    return ig
+
+
+def create_ignore_tree(path):
+    ig = _create_root(path)
     ig.recurse(ig)
     return ig
 
 
+def create_ignore_tree_async(path, cb):
+    """ Like create_ignore_tree(), but walks on background threads. cb(ig) is called from a timeout.
+    Call this from the main thread. """
+    _Walker(_create_root(path), cb).start()
+
+
+class _Walker(object):
+    ''' Walks directories on a few threads. Each job lists one directory and queues its subdirectories.
+
+    The tree comes out the same as Ignore.recurse() builds, except that a directory's
+    subdirectories are walked after all of its files are looked at instead of in between.
+    That only matters if a file is too big and a file with the same name is further down.
+    '''
+    THREADS = 4
+    # ms between checks for the finished tree
+    POLL_INTERVAL = 20
+
+    def __init__(self, root, cb):
+        self.root = root
+        self.cb = cb
+        self.jobs = queue.Queue()
+        # The finished tree is handed back here. Workers never touch the main thread's timers.
+        self.results = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.poll_timeout = None
+
+    def start(self):
+        self._add(self.root)
+        for i in range(self.THREADS):
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+        self.poll_timeout = utils.set_interval(self._poll, self.POLL_INTERVAL)
+
+    def _poll(self):
+        try:
+            root = self.results.get_nowait()
+        except queue.Empty:
+            return
+        utils.cancel_timeout(self.poll_timeout)
+        self.cb(root)
+
+    def _add(self, ig):
+        with self.lock:
+            self.pending += 1
+        self.jobs.put(ig)
+
+    def _run(self):
+        while True:
+            ig = self.jobs.get()
+            if ig is None:
+                return
+            try:
+                for child in list(ig.scan(self.root)):
+                    self._add(child)
+            except Exception as e:
+                msg.error('Error listing path ', ig.path, ': ', str_e(e))
+            with self.lock:
+                self.pending -= 1
+                done = self.pending == 0
+            if done:
+                for i in range(self.THREADS):
+                    self.jobs.put(None)
+                self.root.sum_total_size()
+                self.results.put(self.root)
+
+
+class _Rules(object):
+    ''' One Ignore node's patterns compiled for one value of is_dir.
+
+    Rules are checked in order and the first match wins. Every way a rule can
+    match (same name, same dir, glob on the name, glob on the relative path) goes
+    into a dict or a combined regex that remembers which rule matched, so finding
+    the first matching rule is a few lookups instead of a loop of fnmatch calls.
+    '''
+    # Older Pythons only allow 100 groups per regex
+    CHUNK_SIZE = 90
+
+    def __init__(self, ignores, is_dir):
+        self.rules = []
+        self.names = {}
+        self.base_paths = {}
+        name_patterns = []
+        rel_patterns = []
+        for ignore_file, patterns in ignores.items():
+            for orig_pattern in patterns:
+                pattern = orig_pattern
+                negate = False
+                if pattern[0] in NEGATE_PREFIXES:
+                    negate = True
+                    pattern = pattern[1:]
+                if not pattern:
+                    continue
+                i = len(self.rules)
+                self.rules.append((ignore_file, orig_pattern, negate))
+                if pattern[0] == '/':
+                    rel_patterns.append((i, pattern[1:]))
+                    continue
+                if pattern[-1] == '/' and is_dir:
+                    pattern = pattern[:-1]
+                self.names.setdefault(pattern, i)
+                self.base_paths.setdefault(pattern, i)
+                if pattern[-1] == '/':
+                    self.base_paths.setdefault(pattern[:-1], i)
+                name_patterns.append((i, pattern))
+                rel_patterns.append((i, pattern))
+        self.name_res = self._compile(name_patterns)
+        self.rel_res = self._compile(rel_patterns)
+
+    def _compile(self, patterns):
+        res = []
+        for start in range(0, len(patterns), self.CHUNK_SIZE):
+            chunk = patterns[start:start + self.CHUNK_SIZE]
+            # fnmatch.fnmatch() normcases both sides, so we do too
+            regex = '|'.join(['(?P<r%s>%s)' % (i, fnmatch.translate(os.path.normcase(p))) for i, p in chunk])
+            res.append(re.compile(regex))
+        return res
+
+    def _first(self, res, s):
+        for regex in res:
+            m = regex.match(s)
+            if m:
+                # Alternatives are tried in order, so this is the earliest rule that matches
+                return int(m.lastgroup[1:])
+        return None
+
+    def match(self, rel_path, base_path, file_name):
+        ''' Returns (ignore_file, pattern, negate) for the first matching rule, or None. '''
+        matches = [
+            self.names.get(file_name),
+            self.base_paths.get(base_path),
+            self._first(self.name_res, os.path.normcase(file_name)),
+            self._first(self.rel_res, os.path.normcase(rel_path)),
+        ]
+        matches = [i for i in matches if i is not None]
+        if not matches:
+            return None
+        return self.rules[min(matches)]
+
+
 class Ignore(object):
     def __init__(self, path, parent=None):
         self.parent = parent
@@ -90,10 +251,45 @@ class Ignore(object):
             '/TOO_BIG/': []
         }
         self.path = utils.unfuck_path(path)
+        self._rules = {}
+        self._rules_key = None
 
     def recurse(self, root):
+        for ig in self.scan(root):
+            ig.recurse(root)
+            self.total_size += ig.total_size
+
+    def list_entries(self):
+        """ Returns (name, path, is_dir, is_file, size) for every entry in this dir. Raises OSError. """
+        entries = []
+        if scandir:
+            # DirEntry knows if it's a dir without a stat() on most platforms
+            for entry in list(scandir(self.path)):
+                is_dir = entry.is_dir()
+                s = None
+                if not is_dir:
+                    try:
+                        s = entry.stat()
+                    except Exception as e:
+                        msg.error('Error stat()ing path ', entry.path, ': ', str_e(e))
+                        continue
+                entries.append((entry.name, entry.path, is_dir, bool(s and stat.S_ISREG(s.st_mode)), s and s.st_size))
+            return entries
+
+        for p in os.listdir(self.path):
+            p_path = os.path.join(self.path, p)
+            try:
+                s = os.stat(p_path)
+            except Exception as e:
+                msg.error('Error stat()ing path ', p_path, ': ', str_e(e))
+                continue
+            entries.append((p, p_path, stat.S_ISDIR(s.st_mode), stat.S_ISREG(s.st_mode), s.st_size))
+        return entries
+
+    def scan(self, root):
+        """ Loads ignore files, adds files, and yields a new child Ignore for each subdirectory to recurse into. """
         try:
-            paths = os.listdir(self.path)
+            entries = self.list_entries()
         except OSError as e:
             if e.errno != errno.ENOTDIR:
                 msg.error('Error listing path ', self.path, ': ', str_e(e))
@@ -109,44 +305,42 @@ class Ignore(object):
             except Exception:
                 pass
 
-        for p in paths:
+        for p, p_path, is_dir, is_file, size in entries:
             if p == '.' or p == '..':
                 continue
             if p in BLACKLIST:
                 msg.log('Ignoring blacklisted file ', p)
                 continue
-            p_path = os.path.join(self.path, p)
-            try:
-                s = os.stat(p_path)
-            except Exception as e:
-                msg.error('Error stat()ing path ', p_path, ': ', str_e(e))
-                continue
 
-            if stat.S_ISREG(s.st_mode) and p in HIDDEN_WHITELIST:
+            if is_file and p in HIDDEN_WHITELIST:
                 # Don't count these whitelisted files in size
                 self.files.append(p_path)
                 continue
 
-            is_dir = stat.S_ISDIR(s.st_mode)
             if root.is_ignored(p_path, is_dir, True):
                 continue
 
             if is_dir:
                 ig = Ignore(p_path, self)
                 self.children[p] = ig
-                ig.recurse(root)
-                self.total_size += ig.total_size
+                yield ig
                 continue
 
-            if stat.S_ISREG(s.st_mode):
-                if s.st_size > (MAX_FILE_SIZE):
+            if is_file:
+                if size > (MAX_FILE_SIZE):
                     self.ignores['/TOO_BIG/'].append(p)
                     msg.log(self.is_ignored_message(p_path, p, '/TOO_BIG/', False))
                 else:
-                    self.size += s.st_size
-                    self.total_size += s.st_size
+                    self.size += size
+                    self.total_size += size
                     self.files.append(p_path)
 
+    def sum_total_size(self):
+        self.total_size = self.size
+        for c in self.children.values():
+            self.total_size += c.sum_total_size()
+        return self.total_size
+
     def load(self, ignore_file):
         with open(os.path.join(self.path, ignore_file), 'r') as fd:
             ignores = fd.read()
@@ -197,44 +391,31 @@ class Ignore(object):
         rel_path = os.path.relpath(path, self.path).replace(os.sep, '/')
         return self._is_ignored(rel_path, is_dir, log)
 
+    def _get_rules(self, is_dir):
+        is_dir = bool(is_dir)
+        # Patterns get added (/TOO_BIG/) or replaced (load()) after we're created. Recompile when that happens.
+        key = tuple([(ignore_file, id(patterns), len(patterns)) for ignore_file, patterns in self.ignores.items()])
+        if key != self._rules_key:
+            self._rules = {}
+            self._rules_key = key
+        rules = self._rules.get(is_dir)
+        if rules is None:
+            rules = _Rules(self.ignores, is_dir)
+            self._rules[is_dir] = rules
+        return rules
+
     def _is_ignored(self, rel_path, is_dir, log):
         base_path, file_name = os.path.split(rel_path)
 
         if not is_dir and file_name in HIDDEN_WHITELIST:
             return False
 
-        for ignore_file, patterns in self.ignores.items():
-            for pattern in patterns:
-                orig_pattern = pattern
-                negate = False
-                match = False
-                if pattern[0] in NEGATE_PREFIXES:
-                    negate = True
-                    pattern = pattern[1:]
-
-                if not pattern:
-                    continue
-
-                if pattern[0] == '/':
-                    match = fnmatch.fnmatch(rel_path, pattern[1:])
-                else:
-                    if len(pattern) > 0 and pattern[-1] == '/':
-                        if is_dir:
-                            pattern = pattern[:-1]
-                    if file_name == pattern:
-                        match = True
-                    elif base_path == pattern or (pattern[-1] == '/' and base_path == pattern[:-1]):
-                        match = True
-                    elif fnmatch.fnmatch(file_name, pattern):
-                        match = True
-                    elif fnmatch.fnmatch(rel_path, pattern):
-                        match = True
-                if match:
-                    if log:
-                        msg.log(self.is_ignored_message(rel_path, orig_pattern, ignore_file, negate))
-                    if negate:
-                        return False
-                    return True
+        rule = self._get_rules(is_dir).match(rel_path, base_path, file_name)
+        if rule:
+            ignore_file, pattern, negate = rule
+            if log:
+                msg.log(self.is_ignored_message(rel_path, pattern, ignore_file, negate))
+            return not negate
 
         split = rel_path.split("/", 1)
         if len(split) != 2:
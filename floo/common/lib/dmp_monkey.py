@@ -109,5 +109,195 @@ def patch_apply(self, patches, text):
     return (text, results, positions)
 
 
+def match_main(self, text, pattern, loc):
+    """Locate the best instance of 'pattern' in 'text' near 'loc'.
+
+    Same answer as diff_match_patch.match_main, but tries the nearest exact
+    copies of pattern before falling back to match_bitap.
+
+    Args:
+      text: The text to search.
+      pattern: The pattern to search for.
+      loc: The location to search around.
+
+    Returns:
+      Best match index or -1.
+    """
+    # Check for null inputs.
+    if text is None or pattern is None:
+        raise ValueError("Null inputs. (match_main)")
+
+    loc = max(0, min(loc, len(text)))
+    if text == pattern:
+        # Shortcut (potentially not guaranteed by the algorithm)
+        return 0
+    elif not text:
+        # Nothing to match.
+        return -1
+    elif text[loc:loc + len(pattern)] == pattern:
+        # Perfect match at the perfect spot!  (Includes case of null pattern)
+        return loc
+    match = match_nearby(self, text, pattern, loc)
+    if match != -1:
+        return match
+    # Do a fuzzy compare.
+    return self.match_bitap(text, pattern, loc)
+
+
+def match_nearby(self, text, pattern, loc):
+    """Find the exact copy of 'pattern' closest to 'loc', but only if
+    match_bitap would pick it too. Returns -1 otherwise.
+
+    Any match with errors scores at least 1 / len(pattern), so an exact match
+    that scores less than that beats everything bitap could find.
+    """
+    if not self.Match_Distance:
+        return -1
+    distance = float(self.Match_Distance)
+    fuzzy_score = float(1) / len(pattern)
+    window = int(distance * min(fuzzy_score, self.Match_Threshold)) + 1
+
+    best_loc = text.rfind(pattern, max(0, loc - window), loc + len(pattern) - 1)
+    right = text.find(pattern, loc, loc + window + len(pattern))
+    # On a tie bitap settles on the one to the left
+    if right != -1 and (best_loc == -1 or right - loc < loc - best_loc):
+        best_loc = right
+    if best_loc == -1:
+        return -1
+    score = abs(loc - best_loc) / distance
+    if score > self.Match_Threshold or score >= fuzzy_score:
+        return -1
+    return best_loc
+
+
+def match_bitap(self, text, pattern, loc):
+    """Locate the best instance of 'pattern' in 'text' near 'loc' using the
+    Bitap algorithm.
+
+    Same answer as diff_match_patch.match_bitap. The bit arrays only cover the
+    window being searched instead of all of text up to it, and the inner loop
+    does as little as possible per character.
+
+    Args:
+      text: The text to search.
+      pattern: The pattern to search for.
+      loc: The location to search around.
+
+    Returns:
+      Best match index or -1.
+    """
+    # Initialise the alphabet.
+    s = self.match_alphabet(pattern)
+    pattern_len = len(pattern)
+    text_len = len(text)
+    distance = self.Match_Distance
+
+    def match_bitapScore(e, x):
+        """Compute and return the score for a match with e errors and x location."""
+        accuracy = float(e) / pattern_len
+        proximity = abs(loc - x)
+        if not distance:
+            # Dodge divide by zero error.
+            return proximity and 1.0 or accuracy
+        return accuracy + (proximity / float(distance))
+
+    # Highest score beyond which we give up.
+    score_threshold = self.Match_Threshold
+    # Is there a nearby exact match? (speedup)
+    # Anything further away than the threshold allows can't lower it.
+    if distance:
+        best_loc = text.find(pattern, loc, loc + int(score_threshold * distance) + 1 + pattern_len)
+    else:
+        best_loc = text.find(pattern, loc)
+    if best_loc != -1:
+        score_threshold = min(match_bitapScore(0, best_loc), score_threshold)
+
+    # Initialise the bit arrays.
+    matchmask = 1 << (pattern_len - 1)
+    best_loc = -1
+
+    bin_max = pattern_len + text_len
+    last_rd = None
+    last_start = 0
+    for d in range(pattern_len):
+        # Scan for the best match each iteration allows for one more error.
+        # Run a binary search to determine how far from 'loc' we can stray at
+        # this error level.
+        bin_min = 0
+        bin_mid = bin_max
+        while bin_min < bin_mid:
+            if match_bitapScore(d, loc + bin_mid) <= score_threshold:
+                bin_min = bin_mid
+            else:
+                bin_max = bin_mid
+            bin_mid = (bin_max - bin_min) // 2 + bin_min
+
+        # Use the result from this iteration as the maximum for the next.
+        # The window only shrinks, so it always fits inside last_rd's.
+        bin_max = bin_mid
+        start = max(1, loc - bin_mid + 1)
+        finish = min(loc + bin_mid, text_len) + pattern_len
+
+        # rd[j - start] is rd[j] in the original. char_masks[j - start] is the mask for text[j - 1].
+        size = finish - start + 1
+        char_masks = [s.get(c, 0) for c in text[start - 1:finish]]
+        # Out of range.
+        char_masks.extend([0] * (size - len(char_masks)))
+        rd = [0] * (size + 1)
+        rd[size] = (1 << d) - 1
+        # Scan down to lowest. It goes up when a match right of loc makes anything further left hopeless.
+        i = size - 1
+        lowest = 0
+        if d == 0:
+            # First pass: exact match.
+            while i >= lowest:
+                rd[i] = ((rd[i + 1] << 1) | 1) & char_masks[i]
+                if rd[i] & matchmask:
+                    score = match_bitapScore(d, i + start - 1)
+                    # This match will almost certainly be better than any existing match.
+                    # But check anyway.
+                    if score <= score_threshold:
+                        # Told you so.
+                        score_threshold = score
+                        best_loc = i + start - 1
+                        if best_loc > loc:
+                            # When passing loc, don't exceed our current distance from loc.
+                            lowest = max(0, 2 * loc - best_loc - start)
+                        else:
+                            # Already passed loc, downhill from here on in.
+                            break
+                i -= 1
+        else:
+            # Subsequent passes: fuzzy match.
+            offset = start - last_start
+            while i >= lowest:
+                k = i + offset
+                rd[i] = ((((rd[i + 1] << 1) | 1) & char_masks[i]) |
+                         (((last_rd[k + 1] | last_rd[k]) << 1) | 1) | last_rd[k + 1])
+                if rd[i] & matchmask:
+                    score = match_bitapScore(d, i + start - 1)
+                    # This match will almost certainly be better than any existing match.
+                    # But check anyway.
+                    if score <= score_threshold:
+                        # Told you so.
+                        score_threshold = score
+                        best_loc = i + start - 1
+                        if best_loc > loc:
+                            # When passing loc, don't exceed our current distance from loc.
+                            lowest = max(0, 2 * loc - best_loc - start)
+                        else:
+                            # Already passed loc, downhill from here on in.
+                            break
+                i -= 1
+        # No hope for a (better) match at greater error levels.
+        if match_bitapScore(d + 1, loc) > score_threshold:
+            break
+        last_rd = rd
+        last_start = start
+    return best_loc
+
+
 def monkey_patch():
+    dmp.match_main = match_main
+    dmp.match_bitap = match_bitap
     dmp.patch_apply = patch_apply
@@ -0,0 +1,119 @@
+import collections
+import threading
+
+try:
+    import queue
+    assert queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from . import msg, utils
+    from .exc_fmt import str_e
+except ImportError:
+    import msg
+    import utils
+    from exc_fmt import str_e
+
+
+class PatchWorker(object):
+    ''' Computes FlooPatches for local changes on background threads.
+
+    Jobs for the same buffer run one at a time and their callbacks fire in
+    submission order. Callbacks always run on the thread that calls poll().
+    '''
+    THREADS = 2
+    # Diffing less than this many characters is cheaper than a round trip through a thread
+    INLINE_SIZE = 65536
+
+    def __init__(self):
+        self._jobs = queue.Queue()
+        self._results = collections.deque()
+        self._threads = []
+        # buf id -> jobs waiting for the in-flight one to finish
+        self._waiting = {}
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def submit(self, buf, previous, current, cb, changed=None):
+        ''' cb(buf, patch, patch_json) is called once the patch from previous to current is ready.
+        changed is passed through to FlooPatch. '''
+        # Snapshot the fields FlooPatch needs. The real buf keeps changing while we work.
+        snapshot = {
+            'id': buf['id'],
+            'path': buf['path'],
+            'encoding': buf['encoding'],
+            'buf': previous,
+        }
+        job = (self._generation, buf, snapshot, current, changed, cb)
+        waiting = self._waiting.get(buf['id'])
+        if waiting is not None:
+            waiting.append(job)
+            return
+        size = len(previous) + len(current)
+        if changed:
+            size -= 2 * (changed[0] + changed[1])
+        if size < self.INLINE_SIZE:
+            patch, patch_json = self._make_patch(job)
+            if patch is not None:
+                cb(buf, patch, patch_json)
+            return
+        self._waiting[buf['id']] = collections.deque()
+        self._start(job)
+
+    def poll(self):
+        while self._results:
+            job, patch, patch_json = self._results.popleft()
+            generation, buf, snapshot, current, changed, cb = job
+            if generation != self._generation:
+                continue
+            waiting = self._waiting[buf['id']]
+            if waiting:
+                self._start(waiting.popleft())
+            else:
+                del self._waiting[buf['id']]
+            if patch is not None:
+                cb(buf, patch, patch_json)
+
+    def clear(self):
+        ''' Forget queued jobs. Results of jobs that are already running get dropped. '''
+        self._generation += 1
+        self._waiting = {}
+        try:
+            while True:
+                self._jobs.get_nowait()
+        except queue.Empty:
+            pass
+
+    def stop(self):
+        self.clear()
+        for t in self._threads:
+            self._jobs.put(None)
+        self._threads = []
+
+    def _start(self, job):
+        if len(self._threads) < self.THREADS:
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        self._jobs.put(job)
+
+    def _make_patch(self, job):
+        generation, buf, snapshot, current, changed, cb = job
+        try:
+            patch = utils.FlooPatch(current, snapshot, changed)
+            return patch, patch.to_json()
+        except Exception as e:
+            msg.error('Error making patch for ', snapshot['path'], ': ', str_e(e))
+        return None, None
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            patch, patch_json = self._make_patch(job)
+            self._results.append((job, patch, patch_json))
@@ -14,15 +14,16 @@ except ImportError:
 
 try:
     from ... import editor
-    from .. import api, cert, msg, shared as G, utils
+    from .. import api, b64stream, cert, msg, shared as G, utils
     from ..exc_fmt import str_e
-    from . import base, proxy
+    from . import base, framing, proxy
     assert cert and G and msg and proxy and utils
 except (ImportError, ValueError):
     from floo import editor
-    from floo.common import api, cert, msg, shared as G, utils
+    from floo.common import api, b64stream, cert, msg, shared as G, utils
     from floo.common.exc_fmt import str_e
     import base
+    import framing
     import proxy
 
 try:
@@ -35,6 +36,12 @@ except Exception:
     write_again_errno = (errno.EWOULDBLOCK, errno.EAGAIN) + connect_errno
 
 
+try:
+    memoryview
+except NameError:
+    # Python 2.6
+    memoryview = None
+
 PY2 = sys.version_info < (3, 0)
 
 
@@ -47,6 +54,18 @@ class FlooProtocol(base.BaseProtocol):
     ''' Base FD Interface'''
     MAX_RETRIES = 13
     INITIAL_RECONNECT_DELAY = 500
+    # Stop encoding queued items once this many bytes are waiting to be sent
+    MAX_BUF_OUT = 262144
+    # Max buffers handed to a single sendmsg() call
+    MAX_IOV = 64
+    SEND_SIZE = 65536
+    # Sent before anything else. Auth has no name.
+    CONTROL_EVENTS = (None, 'pong')
+    # Big and not urgent. They share the socket with everything else instead of blocking it.
+    BULK_EVENTS = ('create_buf', 'set_buf')
+    # Bytes each class gets per turn when both are waiting
+    INTERACTIVE_QUANTUM = 65536
+    BULK_QUANTUM = 16384
 
     def __init__(self, host, port, secure=True):
         super(FlooProtocol, self).__init__(host, port, secure)
@@ -54,10 +73,27 @@ class FlooProtocol(base.BaseProtocol):
         self.connected = False
         self._needs_handshake = bool(secure)
         self._sock = None
+        # Control messages (and raw data for proxies) go out first, in order
         self._q = collections.deque()
-        self._slice = bytes()
-        self._buf_in = bytes()
-        self._buf_out = bytes()
+        # (data, buf id) for everything else. See _pop().
+        self._interactive_q = collections.deque()
+        self._bulk_q = collections.deque()
+        # buf id -> [queue, count] for bufs with queued messages. They all stay in one queue so they stay in order.
+        self._buf_queues = {}
+        self._interactive_deficit = 0
+        self._bulk_deficit = 0
+        self._bulk_turn = False
+        self._buf_in = framing.FrameBuffer()
+        self._buf_out = collections.deque()
+        self._buf_out_len = 0
+        # Chunks of the b64stream.Frame being sent, if any
+        self._stream = None
+        self._use_sendmsg = False
+        # Write stats for the most recent write() and totals for this connection
+        self.tick_bytes_sent = 0
+        self.tick_send_calls = 0
+        self.total_bytes_sent = 0
+        self.total_send_calls = 0
         self._reconnect_delay = self.INITIAL_RECONNECT_DELAY
         self._retries = self.MAX_RETRIES
         self._empty_reads = 0
@@ -93,15 +129,11 @@ class FlooProtocol(base.BaseProtocol):
         self._port = self._proc.connect(args)
         return self._port
 
-    def _handle(self, data):
-        self._buf_in += data
+    def _handle(self):
         if self._handling:
             return
         self._handling = True
-        while True:
-            before, sep, after = self._buf_in.partition(b'\n')
-            if not sep:
-                break
+        for before in self._buf_in.frames():
             try:
                 # Node.js sends invalid utf8 even though we're calling write(string, "utf8")
                 # Python 2 can figure it out, but python 3 hates it and will die here with some byte sequences
@@ -112,11 +144,9 @@ class FlooProtocol(base.BaseProtocol):
                 msg.error('Unable to parse json: ', str_e(e))
                 msg.error('Data: ', before)
                 # XXXX: THIS LOSES DATA
-                self._buf_in = after
                 continue
 
             name = data.get('name')
-            self._buf_in = after
             try:
                 msg.debug('got data ' + (name or 'no name'))
                 self.emit('data', name, data)
@@ -153,13 +183,15 @@ class FlooProtocol(base.BaseProtocol):
                 cert_reqs = ssl.CERT_NONE
             self._sock = ssl.wrap_socket(self._sock, ca_certs=self._cert_path, cert_reqs=cert_reqs, do_handshake_on_connect=False)
 
-        self._q.clear()
-        self._buf_out = bytes()
+        # SSL sockets don't do scatter/gather. Neither does Windows or Python 2.
+        self._use_sendmsg = bool(memoryview) and not self._secure and hasattr(self._sock, 'sendmsg')
+        self._clear_q()
+        self._clear_buf_out()
         self.emit('connect')
         self.connected = True
 
     def __len__(self):
-        return len(self._q)
+        return len(self._q) + len(self._interactive_q) + len(self._bulk_q) + len(self._buf_out) + bool(self._stream)
 
     def fileno(self):
         return self._sock and self._sock.fileno()
@@ -173,7 +205,7 @@ class FlooProtocol(base.BaseProtocol):
 
         if self._needs_handshake:
             return writeable.append(fileno)
-        elif len(self) > 0 or self._buf_out:
+        elif len(self) > 0:
             writeable.append(fileno)
 
         readable.append(fileno)
@@ -229,9 +261,8 @@ class FlooProtocol(base.BaseProtocol):
             self._proc.cleanup()
         except Exception:
             pass
-        self._slice = bytes()
-        self._buf_in = bytes()
-        self._buf_out = bytes()
+        self._buf_in.clear()
+        self._clear_buf_out()
         self._sock = None
         self._needs_handshake = self._secure
         self.connected = False
@@ -260,46 +291,148 @@ class FlooProtocol(base.BaseProtocol):
         self.reconnect()
         return False
 
+    def _clear_q(self):
+        self._q.clear()
+        self._interactive_q.clear()
+        self._bulk_q.clear()
+        self._buf_queues = {}
+        self._interactive_deficit = 0
+        self._bulk_deficit = 0
+
+    def _clear_buf_out(self):
+        self._buf_out.clear()
+        self._buf_out_len = 0
+        self._stream = None
+
+    def _pop(self):
+        ''' Returns the next queued item to send, or None.
+
+        Control messages go first. Interactive and bulk queues take turns
+        (deficit round robin): each turn adds its quantum to a queue's byte
+        allowance and it sends items while they fit. A queue with nobody to
+        share with just drains.
+        '''
+        if self._q:
+            return self._q.popleft()
+        while self._interactive_q or self._bulk_q:
+            if not self._bulk_q:
+                self._bulk_deficit = 0
+                return self._pop_from(self._interactive_q)
+            if not self._interactive_q:
+                self._interactive_deficit = 0
+                return self._pop_from(self._bulk_q)
+            if self._bulk_turn:
+                size = len(self._bulk_q[0][0])
+                if size <= self._bulk_deficit:
+                    self._bulk_deficit -= size
+                    return self._pop_from(self._bulk_q)
+                self._bulk_turn = False
+                self._interactive_deficit += self.INTERACTIVE_QUANTUM
+            else:
+                size = len(self._interactive_q[0][0])
+                if size <= self._interactive_deficit:
+                    self._interactive_deficit -= size
+                    return self._pop_from(self._interactive_q)
+                self._bulk_turn = True
+                self._bulk_deficit += self.BULK_QUANTUM
+        return None
+
+    def _pop_from(self, q):
+        data, buf_id = q.popleft()
+        if buf_id is not None:
+            queued = self._buf_queues[buf_id]
+            queued[1] -= 1
+            if not queued[1]:
+                del self._buf_queues[buf_id]
+        return data
+
+    def _fill_buf_out(self):
+        # Encode each queued item exactly once. After that we only pass views of it around.
+        # Frames are read and encoded a chunk at a time so big binary files never sit in memory.
+        while self._buf_out_len < self.MAX_BUF_OUT:
+            if self._stream:
+                try:
+                    data = next(self._stream, None)
+                except (IOError, OSError) as e:
+                    # We can't take back half a message
+                    msg.error('Error sending file: ', str_e(e))
+                    self._stream = None
+                    return self.reconnect()
+                if data is None:
+                    self._stream = None
+                    continue
+            else:
+                data = self._pop()
+                if data is None:
+                    break
+                if isinstance(data, b64stream.Frame):
+                    self._stream = data.chunks()
+                    continue
+                data = data.encode('utf-8')
+            if memoryview:
+                data = memoryview(data)
+            self._buf_out.append(data)
+            self._buf_out_len += len(data)
+
+    def _consume_buf_out(self, sent):
+        self._buf_out_len -= sent
+        while sent:
+            head = self._buf_out[0]
+            if sent < len(head):
+                self._buf_out[0] = head[sent:]
+                return
+            sent -= len(head)
+            self._buf_out.popleft()
+
+    def _send(self):
+        if self._use_sendmsg:
+            bufs = []
+            for buf in self._buf_out:
+                bufs.append(buf)
+                if len(bufs) >= self.MAX_IOV:
+                    break
+            return self._sock.sendmsg(bufs)
+        return self._sock.send(self._buf_out[0][:self.SEND_SIZE])
+
     def write(self):
         sock_debug('Socket is writeable')
         if self._needs_handshake and not self._do_ssl_handshake():
             return
 
         total = 0
-        if not self._slice:
-            self._slice = self._buf_out[total:total + 65536]
+        calls = 0
         try:
             while True:
-                if total < len(self._buf_out) or self._slice:
-                    sent = self._sock.send(self._slice)
-                    sock_debug('Sent %s bytes. Last 10 bytes were %s' % (sent, self._slice[-10:]))
-                    if not sent:
-                        raise IndexError('LOL')
-                    total += sent
-                    self._slice = self._buf_out[total:total + 65536]
-                else:
-                    self._buf_out = self._q.popleft().encode('utf-8')
-                    total = 0
-                    self._slice = self._buf_out[total:total + 65536]
-        except IndexError:
-            pass
+                self._fill_buf_out()
+                if not self._buf_out:
+                    break
+                sent = self._send()
+                calls += 1
+                if not sent:
+                    break
+                total += sent
+                self._consume_buf_out(sent)
         except socket.error as e:
             if e.errno not in write_again_errno:
                 raise
-        self._buf_out = self._buf_out[total:]
-        sock_debug('Done writing for now')
+        finally:
+            self.tick_bytes_sent = total
+            self.tick_send_calls = calls
+            self.total_bytes_sent += total
+            self.total_send_calls += calls
+        sock_debug('Sent %s bytes in %s calls. Done writing for now' % (total, calls))
 
     def read(self):
         sock_debug('Socket is readable')
         if self._needs_handshake and not self._do_ssl_handshake():
             return
-        buf = ''.encode('utf-8')
+        total = 0
         while True:
             try:
-                d = self._sock.recv(65536)
-                if not d:
+                n = self._buf_in.recv_into(self._sock)
+                if not n:
                     break
-                buf += d
+                total += n
                 # ST2 on Windows with Package Control 3 support!
                 # (socket.recv blocks for some damn reason)
                 if G.SOCK_SINGLE_READ:
@@ -311,10 +444,10 @@ class FlooProtocol(base.BaseProtocol):
                 sock_debug('Socket error:', e)
                 break
 
-        if buf:
+        if total:
             self._empty_reads = 0
             # sock_debug('read data')
-            return self._handle(buf)
+            return self._handle()
 
         sock_debug('empty select')
         self._empty_reads += 1
@@ -363,5 +496,26 @@ class FlooProtocol(base.BaseProtocol):
         msg.debug('writing ', item.get('name', 'NO NAME'),
                   ' req_id ', self.req_id,
                   ' qsize ', len(self))
-        self._q.append(json.dumps(item) + '\n')
+        if isinstance(item.get('buf'), b64stream.Base64File):
+            data = b64stream.frame(item)
+        else:
+            data = json.dumps(item) + '\n'
+        name = item.get('name')
+        if name in self.CONTROL_EVENTS:
+            self._q.append(data)
+            return self.req_id
+        buf_id = item.get('id')
+        queued = self._buf_queues.get(buf_id)
+        if queued:
+            # Don't pass earlier messages for the same buf. eg: a patch can't go before the set_buf it's based on.
+            q = queued[0]
+            queued[1] += 1
+        else:
+            if name in self.BULK_EVENTS:
+                q = self._bulk_q
+            else:
+                q = self._interactive_q
+            if buf_id is not None:
+                self._buf_queues[buf_id] = [q, 1]
+        q.append((data, buf_id))
         return self.req_id
@@ -0,0 +1,72 @@
+try:
+    memoryview
+except NameError:
+    # Python 2.6
+    memoryview = None
+
+
+class FrameBuffer(object):
+    ''' Growable inbound buffer that splits newline-delimited frames.
+
+    Data is appended to a single bytearray. A read cursor marks the start of the
+    first unconsumed frame and a scan cursor marks how far we've already looked
+    for newlines, so every byte is copied and searched a constant number of times
+    no matter how the stream is chunked.
+    '''
+    CHUNK_SIZE = 65536
+
+    def __init__(self):
+        self._scratch = bytearray(self.CHUNK_SIZE)
+        self.clear()
+
+    def __len__(self):
+        return len(self._buf) - self._start
+
+    def clear(self):
+        self._buf = bytearray()
+        self._start = 0
+        self._scan = 0
+
+    def feed(self, data):
+        self._buf.extend(data)
+
+    def recv_into(self, sock):
+        ''' Read at most CHUNK_SIZE bytes from sock. Returns the number of bytes read. '''
+        n = sock.recv_into(self._scratch, self.CHUNK_SIZE)
+        if n:
+            if memoryview:
+                self._buf.extend(memoryview(self._scratch)[:n])
+            else:
+                self._buf.extend(self._scratch[:n])
+        return n
+
+    def frames(self):
+        ''' Yields complete frames (without the trailing newline) as bytes. '''
+        while True:
+            index = self._buf.find(b'\n', self._scan)
+            if index == -1:
+                self._scan = len(self._buf)
+                break
+            frame = bytes(self._buf[self._start:index])
+            self._start = self._scan = index + 1
+            yield frame
+        self._compact()
+
+    def read_all(self):
+        ''' Returns and consumes everything buffered, frame boundaries or not. '''
+        data = bytes(self._buf[self._start:])
+        self.clear()
+        return data
+
+    def _compact(self):
+        if self._start == 0:
+            return
+        if self._start >= len(self._buf):
+            self.clear()
+            return
+        # Only shift once the consumed prefix outweighs what's left, so moves stay amortized O(1) per byte.
+        if self._start < self.CHUNK_SIZE or self._start < len(self._buf) - self._start:
+            return
+        del self._buf[:self._start]
+        self._scan -= self._start
+        self._start = 0
@@ -16,8 +16,8 @@ except (ImportError, ValueError):
 # KANS: this should use base, but I want the connection logic from FlooProto (ie, move that shit to base)
 class ProxiedProtocol(floo_proto.FlooProtocol):
     ''' Speaks floo proto, but is given the conn and we don't want to reconnect '''
-    def _handle(self, data):
-        self.proxy(data)
+    def _handle(self):
+        self.proxy(self._buf_in.read_all())
 
 
 class FlooConn(base.BaseHandler):
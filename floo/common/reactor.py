@@ -1,6 +1,13 @@
+import time
 import socket
 import select
 
+try:
+    import selectors
+except ImportError:
+    # Python < 3.4
+    selectors = None
+
 try:
     import ssl
     assert ssl
@@ -8,7 +15,7 @@ except ImportError:
     ssl = False
 
 try:
-    from . import api, msg
+    from . import api, msg, timers, shared as G, utils
     from .. import editor
     from ..common.exc_fmt import str_e, pp_e
     from ..common.handlers import tcp_server
@@ -16,11 +23,14 @@ try:
 except (ImportError, ValueError):
     from floo.common.exc_fmt import str_e, pp_e
     from floo.common.handlers import tcp_server
-    from floo.common import api, msg
+    from floo.common import api, msg, timers, shared as G, utils
     from floo import editor
 
 reactor = None
 
+# Upper bound on how long block() waits in select() when no timer is due sooner
+MAX_BLOCK_TIMEOUT = 1.0
+
 
 class _Reactor(object):
     ''' Low level event driver '''
@@ -28,6 +38,22 @@ class _Reactor(object):
         self._protos = []
         self._handlers = []
         self.on_stop = None
+        self._had_input = False
+        # Adaptive tick state. See start_ticking().
+        self._tick_timeout = None
+        self._tick_count = 0
+        self._tick_rate_start = time.time()
+        self.tick_time = G.TICK_TIME
+        # Ticks per second over the last measured window
+        self.tick_rate = 0.0
+        # proto -> (fileobj, events) for everything registered with self._selector
+        self._registered = {}
+        self._selector = None
+        if selectors:
+            try:
+                self._selector = selectors.DefaultSelector()
+            except Exception as e:
+                msg.warn('Error creating selector. Falling back to select(): ', str_e(e))
 
     def connect(self, factory, host, port, secure, conn=None):
         proto = factory.build_protocol(host, port, secure)
@@ -81,6 +107,59 @@ class _Reactor(object):
                 return False
         return True
 
+    def is_busy(self):
+        if self._had_input:
+            return True
+        for proto in self._protos:
+            if len(proto) > 0:
+                return True
+        for f in self._handlers:
+            if f.is_busy():
+                return True
+        return False
+
+    def start_ticking(self):
+        """ Drive tick() from editor timeouts. Ticks come every MIN_TICK_TIME ms while there's
+        work to do and back off towards MAX_TICK_TIME ms when everything is quiet. """
+        self.stop_ticking()
+        self.tick_time = G.TICK_TIME
+        self._tick_timeout = utils.set_timeout(self._adaptive_tick, 0)
+
+    def stop_ticking(self):
+        utils.cancel_timeout(self._tick_timeout)
+        self._tick_timeout = None
+
+    def wake(self):
+        """ Something needs attention. Tick now instead of waiting out an idle backoff. """
+        if self._tick_timeout is None or self.tick_time <= G.MIN_TICK_TIME:
+            return
+        utils.cancel_timeout(self._tick_timeout)
+        self.tick_time = G.MIN_TICK_TIME
+        self._tick_timeout = utils.set_timeout(self._adaptive_tick, 0)
+
+    def _adaptive_tick(self):
+        self._tick_timeout = None
+        try:
+            self.tick()
+        finally:
+            if self.is_busy():
+                self.tick_time = G.MIN_TICK_TIME
+            else:
+                self.tick_time = min(max(int(self.tick_time * 1.5), G.TICK_TIME), G.MAX_TICK_TIME)
+            self._update_tick_rate()
+            self._tick_timeout = utils.set_timeout(self._adaptive_tick, self.tick_time)
+
+    def _update_tick_rate(self):
+        self._tick_count += 1
+        now = time.time()
+        elapsed = now - self._tick_rate_start
+        if elapsed < 1:
+            return
+        self.tick_rate = self._tick_count / elapsed
+        self._tick_count = 0
+        self._tick_rate_start = now
+        msg.debug('Reactor tick rate ', '%.1f' % self.tick_rate, '/s, interval ', self.tick_time, 'ms')
+
     def _reconnect(self, fd, *fd_sets):
         for fd_set in fd_sets:
             try:
@@ -91,19 +170,130 @@ class _Reactor(object):
 
     @api.send_errors
     def tick(self, timeout=0):
+        self._had_input = False
         for factory in self._handlers:
             factory.tick()
         self.select(timeout)
+        timers.timers.call_timeouts()
         editor.call_timeouts()
 
     def block(self):
+        # We're the event loop now. Don't ask the editor to wake up timers.
+        timers.timers.editor_wakeups = False
         while self._protos or self._handlers:
-            self.tick(.05)
+            timeout = timers.timers.next_timeout()
+            if timeout is None or timeout > MAX_BLOCK_TIMEOUT:
+                timeout = MAX_BLOCK_TIMEOUT
+            self.tick(timeout)
+
+    def _idle(self, timeout):
+        # Nothing to select() on. Don't spin in block().
+        if timeout:
+            time.sleep(timeout)
 
     def select(self, timeout=0):
+        if self._selector:
+            return self._select_selector(timeout)
+        return self._select_select(timeout)
+
+    def _unregister(self, proto):
+        fileobj, _ = self._registered.pop(proto)
+        try:
+            self._selector.unregister(fileobj)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def _update_registration(self, proto):
+        fileno = proto.fileno()
+        events = 0
+        if fileno:
+            readable = []
+            writeable = []
+            proto.fd_set(readable, writeable, [])
+            if readable:
+                events |= selectors.EVENT_READ
+            if writeable:
+                events |= selectors.EVENT_WRITE
+
+        reg = self._registered.get(proto)
+        if not events:
+            if reg:
+                self._unregister(proto)
+            return
+
+        # Sockets are recreated on reconnect and may reuse the old fd number, so compare socket objects when we can
+        fileobj = getattr(proto, '_sock', None) or fileno
+        if reg and reg[0] is not fileobj:
+            self._unregister(proto)
+            reg = None
+        try:
+            if reg is None:
+                self._selector.register(fileobj, events, proto)
+            elif reg[1] != events:
+                self._selector.modify(fileobj, events, proto)
+        except (KeyError, ValueError, OSError, socket.error) as e:
+            msg.error('Error registering ', fileno, ' with selector: ', str_e(e))
+            self._registered.pop(proto, None)
+            proto.reconnect()
+            return
+        self._registered[proto] = (fileobj, events)
+
+    def _select_selector(self, timeout=0):
+        protos = set(self._protos)
+        for proto in list(self._registered):
+            if proto not in protos:
+                self._unregister(proto)
+
         if not self._protos:
+            return self._idle(timeout)
+
+        for proto in self._protos:
+            self._update_registration(proto)
+
+        if not self._registered:
+            return self._idle(timeout)
+
+        try:
+            ready = self._selector.select(timeout)
+        except (select.error, socket.error, Exception) as e:
+            msg.error('Error in selector.select(): ', str_e(e))
             return
 
+        _in = []
+        _out = []
+        for key, events in ready:
+            if events & selectors.EVENT_WRITE:
+                _out.append(key.data)
+            if events & selectors.EVENT_READ:
+                _in.append(key.data)
+        self._had_input = bool(_in)
+
+        for fd in _out:
+            try:
+                fd.write()
+            except ssl.SSLError as e:
+                if e.args[0] != ssl.SSL_ERROR_WANT_WRITE:
+                    raise
+            except Exception as e:
+                msg.error('Couldn\'t write to socket: ', str_e(e))
+                msg.debug('Couldn\'t write to socket: ', pp_e(e))
+                return self._reconnect(fd, _in)
+
+        for fd in _in:
+            try:
+                fd.read()
+            except ssl.SSLError as e:
+                if e.args[0] != ssl.SSL_ERROR_WANT_READ:
+                    raise
+            except Exception as e:
+                msg.error('Couldn\'t read from socket: ', str_e(e))
+                msg.debug('Couldn\'t read from socket: ', pp_e(e))
+                fd.reconnect()
+
+    def _select_select(self, timeout=0):
+        if not self._protos:
+            return self._idle(timeout)
+
         readable = []
         writeable = []
         errorable = []
@@ -117,7 +307,7 @@ class _Reactor(object):
             fd_map[fileno] = fd
 
         if not readable and not writeable:
-            return
+            return self._idle(timeout)
 
         try:
             _in, _out, _except = select.select(readable, writeable, errorable, timeout)
@@ -131,6 +321,8 @@ class _Reactor(object):
                     msg.error('Error in select(): ', fileno, str_e(e))
             return
 
+        self._had_input = bool(_in)
+
         for fileno in _except:
             fd = fd_map[fileno]
             self._reconnect(fd, _in, _out)
@@ -16,6 +16,12 @@ FLOOTTY_SAFE = True
 ALERT_ON_MSG = True
 LOG_TO_CONSOLE = False
 HEARTBEAT_TIMEOUT = 60
+# Only keep open or recently touched buffers in memory. Fetch the rest on demand or in the background.
+LAZY_HYDRATION = False
+# Bytes of buffer contents to keep in memory. Least recently used buffers without views get evicted.
+MAX_BUF_MEMORY = 1024 * 1024 * 256
+# Bytes/second cap on traffic while uploading files. 0 for no limit.
+MAX_UPLOAD_RATE = 0
 
 BASE_DIR = os.path.expanduser(os.path.join('~', 'floobits'))
 
@@ -52,10 +58,17 @@ CHAT_VIEW = None
 CHAT_VIEW_PATH = None
 
 TICK_TIME = 100
+# Adaptive tick bounds (ms). Busy reactors tick every MIN_TICK_TIME, idle ones back off to MAX_TICK_TIME.
+MIN_TICK_TIME = 10
+MAX_TICK_TIME = 1000
 AGENT = None
 IGNORE = None
 
 VIEW_TO_HASH = {}
+# view buffer id -> view.change_count() at which VIEW_TO_HASH was last known to be right
+VIEW_VERSIONS = {}
+# view buffer id -> [change_count, start, suffix_len] of edits that haven't been sent as patches yet
+VIEW_CHANGES = {}
 
 FLOORC_JSON_PATH = os.path.expanduser(os.path.join('~', '.floorc.json'))
 
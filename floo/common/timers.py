@@ -0,0 +1,158 @@
+import heapq
+import threading
+import time
+
+try:
+    from .. import editor
+    from . import msg
+    from .exc_fmt import str_e
+except ImportError:
+    import editor
+    import msg
+    from exc_fmt import str_e
+
+try:
+    now = time.monotonic
+except AttributeError:
+    # Python 2
+    now = time.time
+
+timers = None
+
+# Heap entry layout
+_DEADLINE, _ID, _FUNC, _ARGS, _KWARGS, _INTERVAL = range(6)
+
+
+class _Timers(object):
+    ''' Timer heap shared by everything that calls utils.set_timeout().
+
+    Entries are [deadline, id, func, args, kwargs, interval]. Cancelling clears func
+    and forgets the id. Dead entries get dropped when they reach the top of the heap
+    or when they make up most of it.
+
+    Timers can be added and cancelled from any thread. Callbacks run on whichever
+    thread calls call_timeouts(), without the lock held.
+    '''
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._heap = []
+        self._entries = {}
+        self._last_id = 0
+        self._cancelled = 0
+        self._calling = False
+        self._wakeup_at = None
+        # Ask the editor to call us back when the next timer is due.
+        # Turned off when something else (reactor.block()) drives call_timeouts().
+        self.editor_wakeups = True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def set_timeout(self, func, timeout, *args, **kwargs):
+        return self._add(func, timeout, None, args, kwargs)
+
+    def set_interval(self, func, timeout, *args, **kwargs):
+        return self._add(func, timeout, timeout, args, kwargs)
+
+    def cancel(self, timeout_id):
+        with self._lock:
+            entry = self._entries.pop(timeout_id, None)
+            if entry is None:
+                return
+            entry[_FUNC] = None
+            self._cancelled += 1
+            if self._cancelled > 64 and self._cancelled > len(self._heap) / 2:
+                self._heap = [e for e in self._heap if e[_FUNC] is not None]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def next_timeout(self):
+        ''' Seconds until the next timer is due, or None if there are no timers. '''
+        with self._lock:
+            self._drop_cancelled()
+            if not self._heap:
+                return None
+            return max(0, self._heap[0][_DEADLINE] - now())
+
+    def call_timeouts(self):
+        with self._lock:
+            if self._calling:
+                return
+            self._calling = True
+            # Timers added or re-armed by callbacks wait for the next call, even if they're already due
+            last_id = self._last_id
+        rearm = []
+        try:
+            while True:
+                with self._lock:
+                    self._drop_cancelled()
+                    if not self._heap:
+                        break
+                    entry = self._heap[0]
+                    if entry[_DEADLINE] > now() or entry[_ID] > last_id:
+                        break
+                    heapq.heappop(self._heap)
+                    func = entry[_FUNC]
+                    interval = entry[_INTERVAL]
+                    if interval is None:
+                        del self._entries[entry[_ID]]
+                try:
+                    func(*entry[_ARGS], **entry[_KWARGS])
+                except Exception as e:
+                    msg.error('Error in timeout ', getattr(func, '__name__', func), ': ', str_e(e))
+                    with self._lock:
+                        self._entries.pop(entry[_ID], None)
+                    continue
+                if interval is not None:
+                    rearm.append(entry)
+        finally:
+            with self._lock:
+                for entry in rearm:
+                    if entry[_FUNC] is None:
+                        # Cancelled itself while it wasn't in the heap
+                        self._cancelled -= 1
+                        continue
+                    entry[_DEADLINE] = now() + entry[_INTERVAL] / 1000.0
+                    heapq.heappush(self._heap, entry)
+                self._calling = False
+        self._arm_wakeup()
+
+    def _add(self, func, timeout, interval, args, kwargs):
+        with self._lock:
+            self._last_id += 1
+            timeout_id = self._last_id
+            entry = [now() + timeout / 1000.0, timeout_id, func, args, kwargs, interval]
+            self._entries[timeout_id] = entry
+            heapq.heappush(self._heap, entry)
+            if not self._calling:
+                self._arm_wakeup()
+        return timeout_id
+
+    def _drop_cancelled(self):
+        while self._heap and self._heap[0][_FUNC] is None:
+            heapq.heappop(self._heap)
+            self._cancelled -= 1
+
+    def _arm_wakeup(self):
+        if not self.editor_wakeups:
+            return
+        with self._lock:
+            self._drop_cancelled()
+            if not self._heap:
+                return
+            deadline = self._heap[0][_DEADLINE]
+            if self._wakeup_at is not None and self._wakeup_at <= deadline:
+                return
+            self._wakeup_at = deadline
+
+        def wakeup():
+            with self._lock:
+                if self._wakeup_at == deadline:
+                    self._wakeup_at = None
+            self.call_timeouts()
+
+        editor.set_timeout(wakeup, max(0, int((deadline - now()) * 1000)))
+
+
+timers = _Timers()
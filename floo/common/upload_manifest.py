@@ -0,0 +1,115 @@
+import os
+import json
+import hashlib
+import collections
+
+try:
+    from . import msg, shared as G, utils
+    from .exc_fmt import str_e
+except ImportError:
+    import msg
+    import shared as G
+    import utils
+    from exc_fmt import str_e
+
+MANIFEST_DIR = 'upload_manifests'
+
+
+class UploadManifest(object):
+    ''' What's left of an upload, kept on disk so a reconnect can pick up where it stopped.
+
+    pending holds relative paths to upload. It's an OrderedDict used as an ordered set
+    (the values are always None): uploads go out in order, but acks come back in any
+    order and each one has to remove its path cheaply. deletes are paths of bufs to
+    delete. On resume, _scan_dir decides what still differs from the server, so nothing
+    about the contents is kept here. Each workspace + local path gets its own file in
+    G.BASE_DIR/upload_manifests, which goes away once nothing is left.
+    '''
+    VERSION = 1
+    # ms to wait before writing acks to disk
+    SAVE_DELAY = 1000
+
+    def __init__(self, workspace_url, project_path):
+        self.key = '%s\n%s' % (workspace_url, project_path)
+        name = hashlib.md5(self.key.encode('utf-8')).hexdigest()
+        self.dir = os.path.join(G.BASE_DIR, MANIFEST_DIR)
+        self.path = os.path.join(self.dir, name + '.json')
+        self.pending = collections.OrderedDict()
+        self.deletes = set()
+        self.acked = 0
+        self.save_timeout = None
+        self.load()
+
+    def __len__(self):
+        return len(self.pending) + len(self.deletes)
+
+    def add(self, paths, deletes=()):
+        for path in paths:
+            if path not in self.pending:
+                self.pending[path] = None
+        self.deletes.update(deletes)
+        self.save()
+
+    def clear(self):
+        self.pending.clear()
+        self.deletes.clear()
+        self.save()
+
+    def ack(self, path):
+        ''' The server has path (or there's nothing to do for it). '''
+        if path not in self.pending and path not in self.deletes:
+            return
+        self.pending.pop(path, None)
+        self.deletes.discard(path)
+        self.acked += 1
+        if self:
+            self._save_later()
+        else:
+            msg.log('Upload finished. ', self.acked, ' files acknowledged.')
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as fd:
+                data = json.loads(fd.read().decode('utf-8'))
+        except (IOError, OSError):
+            return
+        except Exception as e:
+            msg.debug('Error reading upload manifest ', self.path, ': ', str_e(e))
+            return
+        if data.get('version') != self.VERSION or data.get('key') != self.key:
+            return
+        self.pending = collections.OrderedDict((p, None) for p in data.get('pending', []))
+        self.deletes = set(data.get('deletes', []))
+        msg.debug('Loaded upload manifest with ', len(self.pending), ' uploads and ', len(self.deletes), ' deletes left.')
+
+    def save(self):
+        utils.cancel_timeout(self.save_timeout)
+        self.save_timeout = None
+        if not self:
+            try:
+                os.remove(self.path)
+            except (IOError, OSError):
+                pass
+            return
+        data = {
+            'version': self.VERSION,
+            'key': self.key,
+            'pending': list(self.pending.keys()),
+            'deletes': list(self.deletes),
+        }
+        tmp_path = self.path + '.tmp'
+        try:
+            utils.mkdir(self.dir)
+            with open(tmp_path, 'wb') as fd:
+                fd.write(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+            if os.path.exists(self.path):
+                # Windows won't rename over an existing file
+                os.remove(self.path)
+            os.rename(tmp_path, self.path)
+        except Exception as e:
+            msg.error('Error writing upload manifest ', self.path, ': ', str_e(e))
+
+    def _save_later(self):
+        if self.save_timeout is None:
+            self.save_timeout = utils.set_timeout(self.save, self.SAVE_DELAY)
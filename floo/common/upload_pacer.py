@@ -0,0 +1,152 @@
+import collections
+import time
+
+try:
+    from . import shared as G
+except ImportError:
+    import shared as G
+
+
+def format_bytes(n):
+    for unit in ('B', 'KB', 'MB'):
+        if n < 1024:
+            return '%.1f %s' % (n, unit)
+        n /= 1024.0
+    return '%.1f GB' % n
+
+
+def format_time(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return '%ss' % seconds
+    if seconds < 3600:
+        return '%sm %ss' % (seconds // 60, seconds % 60)
+    return '%sh %sm' % (seconds // 3600, seconds % 3600 // 60)
+
+
+class UploadPacer(object):
+    ''' Decides how much _rate_limited_upload() sends at a time.
+
+    Throughput comes from how fast the protocol drains each batch (FlooProtocol.write()
+    counts bytes sent). RTT is how long the server takes to ack a batch's last message
+    after it's written. Batches are sized to keep about one RTT of data in flight, and
+    total traffic stays under G.MAX_UPLOAD_RATE if it's set.
+    '''
+    MIN_BATCH = 64 * 1024
+    MAX_BATCH = 8 * 1024 * 1024
+    # Seconds. Batches cover at least this long even if RTT is tiny.
+    MIN_WINDOW = 0.05
+    # Weight of the newest throughput and RTT samples
+    ALPHA = 0.3
+    # Seconds of history behind the throughput in the status bar
+    STATUS_WINDOW = 5
+
+    def __init__(self, proto, total_bytes, bytes_uploaded=0.0):
+        self.proto = proto
+        self.total_bytes = total_bytes
+        self.bytes_uploaded = bytes_uploaded
+        # Bytes/second and seconds. None until we have a sample.
+        self.rate = None
+        self.rtt = None
+        self.started = time.time()
+        self._sent_at_start = proto.total_bytes_sent
+        # Bytes we're allowed to send under G.MAX_UPLOAD_RATE. Goes negative after a big file.
+        self._allowance = 0.0
+        self._last_check = self.started
+        self._last_sent = proto.total_bytes_sent
+        self._batch_start = None
+        self._ack_id = None
+        self._acked_at = None
+        self._drained_at = None
+        # (time, total bytes sent) for the status bar
+        self._history = collections.deque([(self.started, proto.total_bytes_sent)])
+
+    def ready(self):
+        ''' True once the last batch has been written and the rate limit allows more. '''
+        now = time.time()
+        sent = self.proto.total_bytes_sent
+        if G.MAX_UPLOAD_RATE:
+            self._allowance += (now - self._last_check) * G.MAX_UPLOAD_RATE - (sent - self._last_sent)
+            self._allowance = min(self._allowance, G.MAX_UPLOAD_RATE * self.MIN_WINDOW)
+        self._last_check = now
+        self._last_sent = sent
+        self._history.append((now, sent))
+        while len(self._history) > 2 and self._history[1][0] < now - self.STATUS_WINDOW:
+            self._history.popleft()
+
+        if len(self.proto) > 0:
+            return False
+        if self._batch_start is not None:
+            start_time, start_sent = self._batch_start
+            self._batch_start = None
+            self._drained_at = now
+            if now > start_time and sent > start_sent:
+                self.rate = self._average(self.rate, (sent - start_sent) / (now - start_time))
+            if self._acked_at is not None:
+                # Acked before we noticed it was written. RTT is less than a tick.
+                self._sample_rtt(0)
+        return not G.MAX_UPLOAD_RATE or self._allowance >= 0
+
+    def batch_size(self):
+        ''' Bytes of files to upload this time. '''
+        if self.rate is None:
+            size = self.MIN_BATCH
+        else:
+            size = self.rate * max(self.rtt or 0, self.MIN_WINDOW)
+        if G.MAX_UPLOAD_RATE:
+            size = min(size, G.MAX_UPLOAD_RATE * self.MIN_WINDOW)
+            return max(1, int(size))
+        return int(min(max(size, self.MIN_BATCH), self.MAX_BATCH))
+
+    def sent(self, size, last_req_id=None):
+        ''' Call after uploading a batch. last_req_id is the batch's last message, if any. '''
+        self.bytes_uploaded += size
+        self._batch_start = (time.time(), self.proto.total_bytes_sent)
+        self._ack_id = last_req_id
+        self._acked_at = None
+        self._drained_at = None
+
+    def on_ack(self, res_id):
+        if res_id is None or res_id != self._ack_id:
+            return
+        self._ack_id = None
+        if self._drained_at is None:
+            self._acked_at = time.time()
+            return
+        self._sample_rtt(time.time() - self._drained_at)
+
+    def status(self):
+        bar_len = 20
+        try:
+            percent = min(1.0, self.bytes_uploaded / self.total_bytes)
+        except ZeroDivisionError:
+            percent = 0.5
+        bar = '   |' + ('|' * int(bar_len * percent)) + (' ' * int((1 - percent) * bar_len)) + '|'
+        status = 'Uploading... %2.2f%% %s' % (percent * 100, bar)
+        throughput = self.throughput()
+        if throughput:
+            left = max(0, self.total_bytes - self.bytes_uploaded)
+            status += ' %s/s, %s left' % (format_bytes(throughput), format_time(left / throughput))
+        return status
+
+    def throughput(self):
+        ''' Bytes/second actually sent over the last few seconds, including time spent waiting. '''
+        start_time, start_sent = self._history[0]
+        end_time, end_sent = self._history[-1]
+        if end_time - start_time < 0.5:
+            return None
+        return (end_sent - start_sent) / (end_time - start_time)
+
+    def summary(self):
+        elapsed = time.time() - self.started
+        sent = self.proto.total_bytes_sent - self._sent_at_start
+        return 'Sent %s in %s (%s/s).' % (format_bytes(sent), format_time(elapsed), format_bytes(sent / max(elapsed, 0.001)))
+
+    def _sample_rtt(self, rtt):
+        self._acked_at = None
+        self.rtt = self._average(self.rtt, rtt)
+
+    def _average(self, old, sample):
+        if old is None:
+            return sample
+        return old + self.ALPHA * (sample - old)
@@ -18,12 +18,13 @@ try:
     from .. import editor
     from . import shared as G
     from .exc_fmt import str_e
-    from . import msg
+    from . import msg, timers
     from .lib import DMP
     assert G and DMP
 except ImportError:
     import editor
     import msg
+    import timers
     from exc_fmt import str_e
     import shared as G
     from lib import DMP
@@ -36,10 +37,13 @@ class JOIN_ACTION(object):
 
 
 class FlooPatch(object):
-    def __init__(self, current, buf):
+    def __init__(self, current, buf, changed=None):
+        """ changed is an optional (start, suffix_len) hint: everything before start and the last suffix_len
+        characters are the same in both texts. Only the text between them gets diffed. """
         self.buf = buf
         self.current = current
         self.previous = buf['buf']
+        self.changed = changed
         if buf['encoding'] == 'base64':
             self.md5_before = hashlib.md5(self.previous).hexdigest()
             self.md5_after = hashlib.md5(self.current).hexdigest()
@@ -61,7 +65,36 @@ class FlooPatch(object):
         return '%s - %s' % (self.buf['id'], self.buf['path'])
 
     def patches(self):
-        return DMP.patch_make(self.previous, self.current)
+        diffs = self._diff_changed()
+        if diffs is None:
+            return DMP.patch_make(self.previous, self.current)
+        return DMP.patch_make(self.previous, diffs)
+
+    def _diff_changed(self):
+        if not self.changed:
+            return None
+        start, suffix_len = self.changed
+        prev_end = len(self.previous) - suffix_len
+        cur_end = len(self.current) - suffix_len
+        if start < 0 or suffix_len < 0 or prev_end < start or cur_end < start:
+            return None
+        prefix = self.previous[:start]
+        suffix = self.previous[prev_end:]
+        # Hints come from editor events. Don't trust them blindly.
+        if not self.current.startswith(prefix) or not self.current.endswith(suffix):
+            msg.debug('Change hint for ', str(self), ' is wrong. Diffing whole buffer.')
+            return None
+        # Same steps patch_make() takes, minus searching for the common prefix/suffix
+        diffs = DMP.diff_main(self.previous[start:prev_end], self.current[start:cur_end], True)
+        if prefix:
+            diffs.insert(0, (DMP.DIFF_EQUAL, prefix))
+        if suffix:
+            diffs.append((DMP.DIFF_EQUAL, suffix))
+        DMP.diff_cleanupMerge(diffs)
+        if len(diffs) > 2:
+            DMP.diff_cleanupSemantic(diffs)
+            DMP.diff_cleanupEfficiency(diffs)
+        return diffs
 
     def to_json(self):
         patches = self.patches()
@@ -161,10 +194,6 @@ def can_auth(host=None):
     return False
 
 
-cancelled_timeouts = set()
-timeout_ids = set()
-
-
 def set_timeout(func, timeout, *args, **kwargs):
     return _set_timeout(func, timeout, False, *args, **kwargs)
 
@@ -174,12 +203,6 @@ def set_interval(func, timeout, *args, **kwargs):
 
 
 def _set_timeout(func, timeout, repeat, *args, **kwargs):
-    timeout_id = set_timeout._top_timeout_id
-    if timeout_id > 100000:
-        set_timeout._top_timeout_id = 0
-    else:
-        set_timeout._top_timeout_id += 1
-
     try:
         from . import api
     except ImportError:
@@ -187,28 +210,15 @@ def _set_timeout(func, timeout, repeat, *args, **kwargs):
 
     @api.send_errors
     def timeout_func():
-        timeout_ids.discard(timeout_id)
-        if timeout_id in cancelled_timeouts:
-            cancelled_timeouts.remove(timeout_id)
-            return
-
         func(*args, **kwargs)
 
-        if repeat:
-            editor.set_timeout(timeout_func, timeout)
-            timeout_ids.add(timeout_id)
-
-    editor.set_timeout(timeout_func, timeout)
-    timeout_ids.add(timeout_id)
-    return timeout_id
-
-
-set_timeout._top_timeout_id = 0
+    if repeat:
+        return timers.timers.set_interval(timeout_func, timeout)
+    return timers.timers.set_timeout(timeout_func, timeout)
 
 
 def cancel_timeout(timeout_id):
-    if timeout_id in timeout_ids:
-        cancelled_timeouts.add(timeout_id)
+    timers.timers.cancel(timeout_id)
 
 
 rate_limits = {}
@@ -494,6 +504,8 @@ def save_buf(buf):
                 fd.write(buf['buf'])
     except Exception as e:
         msg.error('Error saving buf: ', str_e(e))
+        return False
+    return True
 
 
 def _unwind_generator(gen_expr, cb=None, res=None):
@@ -559,6 +571,54 @@ def inlined_callbacks(f):
     return wrap
 
 
+# How long time_sliced() runs before giving the editor a turn
+SLICE_TIME = 0.02
+
+
+def time_sliced(items, func, cb):
+    """ Calls func(item) for each item, stopping every SLICE_TIME seconds to let everything else run.
+    Meant to be yielded from inlined_callbacks functions. cb() is called once every item is done. """
+    items = iter(items)
+
+    def run():
+        deadline = time.time() + SLICE_TIME
+        for item in items:
+            func(item)
+            if time.time() >= deadline:
+                set_timeout(run, 0)
+                return
+        cb()
+    run()
+
+
+class StageTimer(object):
+    """ Shows which stage of a long operation we're in and logs how long each one took. """
+
+    def __init__(self, name):
+        self.name = name
+        self.timings = []
+        self.current = None
+        self.start = None
+
+    def stage(self, name):
+        self._finish()
+        self.current = name
+        self.start = time.time()
+        editor.status_message('%s: %s...' % (self.name, name))
+
+    def done(self):
+        self._finish()
+        total = sum([t for name, t in self.timings])
+        timings = ', '.join(['%s %.2fs' % (name, t) for name, t in self.timings])
+        msg.log(self.name, ' took %.2fs: ' % total, timings)
+
+    def _finish(self):
+        if self.current is None:
+            return
+        self.timings.append((self.current, time.time() - self.start))
+        self.current = None
+
+
 def has_browser():
     valid_browsers = [
         "MacOSX",  # Default mac browser.
@@ -6,12 +6,12 @@ import collections
 import sublime_plugin
 
 try:
-    from .common import msg, shared as G, utils
-    from .sublime_utils import get_buf, get_text
+    from .common import msg, reactor, shared as G, utils
+    from .sublime_utils import get_buf, get_text, track_changes, view_index
     assert G and G and utils and msg and get_buf and get_text
 except ImportError:
-    from common import msg, shared as G, utils
-    from sublime_utils import get_buf, get_text
+    from common import msg, reactor, shared as G, utils
+    from sublime_utils import get_buf, get_text, track_changes, view_index
 
 
 def if_connected(f):
@@ -24,7 +24,7 @@ def if_connected(f):
     return wrapped
 
 
-def is_view_loaded(view):
+def is_view_loaded(view, touch=True):
     """returns a buf if the view is loaded in sublime and
     the buf is populated by us"""
 
@@ -36,7 +36,7 @@ def is_view_loaded(view):
         return
 
     buf = get_buf(view)
-    if not buf or buf.get('buf') is None:
+    if not buf or not G.AGENT.load_buf(buf, touch):
         return
 
     return buf
@@ -113,6 +113,7 @@ class Listener(sublime_plugin.EventListener):
     @if_connected
     def on_clone(self, view, agent):
         msg.debug('Sublime cloned ', self.name(view))
+        view_index.add(view)
         buf = get_buf(view)
         if not buf:
             return
@@ -126,10 +127,12 @@ class Listener(sublime_plugin.EventListener):
     @if_connected
     def on_close(self, view, agent):
         msg.debug('Sublime closed view ', self.name(view))
+        view_index.remove(view)
 
     @if_connected
     def on_load(self, view, agent):
         msg.debug('Sublime loaded ', self.name(view))
+        view_index.add(view)
         buf = get_buf(view)
         if not buf:
             return
@@ -156,6 +159,8 @@ class Listener(sublime_plugin.EventListener):
 
     @if_connected
     def on_post_save(self, view, agent):
+        # Save as might have changed the file name
+        view_index.add(view)
         view_buf_id = view.buffer_id()
 
         def cleanup():
@@ -215,6 +220,7 @@ class Listener(sublime_plugin.EventListener):
             agent.send(event)
         if is_shared and buf:
             agent.views_changed.append(('saved', view, buf))
+            reactor.reactor.wake()
 
         cleanup()
 
@@ -224,27 +230,35 @@ class Listener(sublime_plugin.EventListener):
         if not buf:
             return
 
-        text = get_text(view)
         if buf['encoding'] != 'utf8':
             return msg.warn('Floobits does not support patching binary files at this time')
 
-        text = text.encode('utf-8')
-        view_md5 = hashlib.md5(text).hexdigest()
         bid = view.buffer_id()
+        change_count = view.change_count()
         buf['forced_patch'] = False
-        if view_md5 == G.VIEW_TO_HASH.get(bid):
-            self._highlights.add(bid)
-            return
+        if bid in G.VIEW_TO_HASH:
+            synced = G.VIEW_VERSIONS.get(bid) == change_count
+            known_md5 = G.VIEW_TO_HASH[bid]
+            if not synced and known_md5 is not None:
+                # Synced by something that only knew the hash. Check it once, then trust change_count.
+                synced = known_md5 == hashlib.md5(get_text(view).encode('utf-8')).hexdigest()
+            if synced:
+                G.VIEW_VERSIONS[bid] = change_count
+                self._highlights.add(bid)
+                return
 
-        G.VIEW_TO_HASH[view.buffer_id()] = view_md5
+        # Don't hash anything. The patch has the md5s.
+        G.VIEW_TO_HASH[bid] = None
+        G.VIEW_VERSIONS[bid] = change_count
         msg.debug('changed view ', buf['path'], ' buf id ', buf['id'])
         if not activated:
             self.disable_follow_mode(2000)
         agent.views_changed.append(('patch', view, buf))
+        reactor.reactor.wake()
 
     @if_connected
     def on_selection_modified(self, view, agent):
-        buf = is_view_loaded(view)
+        buf = is_view_loaded(view, touch=False)
         if not buf or 'highlight' not in G.PERMS:
             return
         c = [[x.a, x.b] for x in view.sel()]
@@ -274,9 +288,29 @@ class Listener(sublime_plugin.EventListener):
 
     @if_connected
     def on_activated(self, view, agent):
+        # Previews don't get on_load when they become tabs
+        view_index.add(view)
         buf = get_buf(view)
         if not buf:
             return
         msg.debug('activated view ', buf['path'], ' buf id ', buf['id'])
         self.on_modified(view, agent, True)
         self.on_selection_modified(view)
+
+
+# Sublime Text 4+ tells us exactly what changed. Use that to avoid diffing whole buffers.
+if hasattr(sublime_plugin, 'TextChangeListener'):
+    class ChangeTracker(sublime_plugin.TextChangeListener):
+
+        @classmethod
+        def is_applicable(cls, buffer):
+            return True
+
+        def on_text_changed(self, changes):
+            if not G.AGENT or not G.AGENT.joined_workspace:
+                return
+            view = self.buffer.primary_view()
+            if view:
+                track_changes(view, changes)
+else:
+    ChangeTracker = None
@@ -2,19 +2,10 @@
 
 from __future__ import print_function
 
-from collections import defaultdict
 import json
 import optparse
 import platform
 import sys
-import time
-import copy
-
-# Monkey patch editor
-timeouts = defaultdict(list)
-top_timeout_id = 0
-cancelled_timeouts = set()
-calling_timeouts = False
 
 
 def name():
@@ -41,54 +32,17 @@ def _platform():
     return platform.platform()
 
 
-def set_timeout(func, timeout, *args, **kwargs):
-    global top_timeout_id
-    timeout_id = top_timeout_id
-    top_timeout_id + 1
-    if top_timeout_id > 100000:
-        top_timeout_id = 0
-
-    def timeout_func():
-        if timeout_id in cancelled_timeouts:
-            cancelled_timeouts.remove(timeout_id)
-            return
-        func(*args, **kwargs)
-
-    then = time.time() + (timeout / 1000.0)
-    timeouts[then].append(timeout_func)
-    return timeout_id
-
-
-def cancel_timeout(timeout_id):
-    if timeout_id in timeouts:
-        cancelled_timeouts.add(timeout_id)
-
-
-def call_timeouts():
-    global calling_timeouts
-    if calling_timeouts:
-        return
-    calling_timeouts = True
-    now = time.time()
-    for t, tos in copy.copy(timeouts).items():
-        if now >= t:
-            for timeout in tos:
-                timeout()
-            del timeouts[t]
-    calling_timeouts = False
-
-
 def open_file(file):
     pass
 
 
 try:
-    from .common import api, msg, shared as G, utils, reactor, event_emitter
+    from .common import api, msg, shared as G, utils, reactor, event_emitter, timers
     from .common.handlers import base
     from .common.protocols import floo_proto
     from . import editor
 except (ImportError, ValueError):
-    from common import api, msg, shared as G, utils, reactor, event_emitter
+    from common import api, msg, shared as G, utils, reactor, event_emitter, timers
     from common.handlers import base
     from common.protocols import floo_proto
     import editor
@@ -99,14 +53,17 @@ def editor_log(msg):
     sys.stdout.flush()
 
 
+# Monkey patch editor
 editor.name = name
 editor.ok_cancel_dialog = ok_cancel_dialog
 editor.error_message = error_message
 editor.status_message = status_message
 editor.platform = _platform
-editor.set_timeout = set_timeout
-editor.cancel_timeout = cancel_timeout
-editor.call_timeouts = call_timeouts
+# reactor.block() drives the shared timer heap for us
+timers.timers.editor_wakeups = False
+editor.set_timeout = timers.timers.set_timeout
+editor.cancel_timeout = timers.timers.cancel
+editor.call_timeouts = timers.timers.call_timeouts
 editor.open_file = open_file
 msg.editor_log = editor_log
 
@@ -137,11 +94,11 @@ class RemoteProtocol(floo_proto.FlooProtocol):
         super(RemoteProtocol, self).__init__(*args, **kwargs)
         eventStream.on('to_floobits', self._q.append)
 
-    def _handle(self, data):
+    def _handle(self):
         # Node.js sends invalid utf8 even though we're calling write(string, "utf8")
         # Python 2 can figure it out, but python 3 hates it and will die here with some byte sequences
         # Instead of crashing the plugin, we drop the data. Yes, this is horrible.
-        data = data.decode('utf-8', 'ignore')
+        data = self._buf_in.read_all().decode('utf-8', 'ignore')
         eventStream.emit('from_floobits', data)
 
     def reconnect(self):
@@ -193,7 +150,8 @@ class LocalProtocol(floo_proto.FlooProtocol):
             item = self.to_proxy.pop(0)
             eventStream.emit('to_floobits', item.decode('utf-8'))
 
-    def _handle(self, data):
+    def _handle(self):
+        data = self._buf_in.read_all()
         if self.remote_conn:
             eventStream.emit('to_floobits', data.decode('utf-8'))
         else:
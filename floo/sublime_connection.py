@@ -1,4 +1,5 @@
 import os
+import time
 import sublime
 import collections
 
@@ -10,28 +11,30 @@ except ImportError:
 
 try:
     from . import editor
-    from .common import msg, shared as G, utils
+    from .common import msg, patch_worker, shared as G, utils
     from .common.exc_fmt import str_e
     from .view import View
     from .common.handlers import floo_handler
-    from .sublime_utils import create_view, get_buf, send_summon, get_view_in_group, get_text
+    from .sublime_utils import create_view, get_buf, send_summon, get_view_in_group, get_text, pop_changes, view_index
     assert G and msg and utils
 except ImportError:
     from floo import editor
-    from common import msg, shared as G, utils
+    from common import msg, patch_worker, shared as G, utils
     from common.exc_fmt import str_e
     from common.handlers import floo_handler
     from view import View
-    from sublime_utils import create_view, get_buf, send_summon, get_view_in_group, get_text
+    from sublime_utils import create_view, get_buf, send_summon, get_view_in_group, get_text, pop_changes, view_index
 
 
 class SublimeConnection(floo_handler.FlooHandler):
     def __init__(self, owner, workspace, context, auth, action):
+        self.patch_worker = patch_worker.PatchWorker()
         super(SublimeConnection, self).__init__(owner, workspace, auth, action)
         self.context = context
         self.on('room_info', self.log_users)
 
     def tick(self):
+        self.patch_worker.poll()
         if 'patch' not in G.PERMS:
             self.views_changed = []
         elif not self.joined_workspace:
@@ -53,11 +56,11 @@ class SublimeConnection(floo_handler.FlooHandler):
                     continue
                 reported.add((name, view.native_id))
                 if name == 'patch':
-                    patch = utils.FlooPatch(view.get_text(), buf)
-                    # Update the current copy of the buffer
-                    buf['buf'] = patch.current
-                    buf['md5'] = patch.md5_after
-                    self.send(patch.to_json())
+                    previous = buf['buf']
+                    # Update the current copy of the buffer now. md5 gets updated once the patch is made.
+                    buf['buf'] = view.get_text()
+                    self.bufs.touch(buf['id'])
+                    self.patch_worker.submit(buf, previous, buf['buf'], self._send_patch, pop_changes(v))
                     continue
                 if name == 'saved':
                     to_send.append({'name': 'saved', 'id': buf['id']})
@@ -67,12 +70,23 @@ class SublimeConnection(floo_handler.FlooHandler):
             for s in to_send:
                 self.send(s)
 
-        self._status_timeout += 1
-        if self._status_timeout > (2000 / G.TICK_TIME):
+        if time.time() - self._last_status_update > 2:
             self.update_status_msg()
 
+    def _send_patch(self, buf, patch, patch_json):
+        if self.bufs.get(buf['id']) is not buf:
+            msg.debug('Buf ', buf['path'], ' was replaced while making a patch. Discarding patch.')
+            return
+        # Don't clobber the md5 if something else (like an incoming patch) updated the buffer in the meantime
+        if buf.get('buf') is patch.current:
+            buf['md5'] = patch.md5_after
+        self.send(patch_json)
+
+    def is_busy(self):
+        return bool(self.views_changed) or len(self.patch_worker) > 0
+
     def update_status_msg(self, extra=''):
-        self._status_timeout = 0
+        self._last_status_update = time.time()
         status = '%s@%s/%s: ' % (self.username, self.owner, self.workspace)
         if G.FOLLOW_MODE:
             status += 'Following ' + (' '.join(G.FOLLOW_USERS) or 'changes') + '. '
@@ -200,30 +214,18 @@ class SublimeConnection(floo_handler.FlooHandler):
         sublime.status_message(msg)
 
     def get_view_text_by_path(self, path):
-        for v in G.WORKSPACE_WINDOW.views():
-            if not v.file_name():
-                continue
-            try:
-                rel_path = utils.to_rel_path(v.file_name())
-            except ValueError:
-                continue
-            if path == rel_path:
-                return get_text(v)
+        v = view_index.get(path)
+        if v:
+            return get_text(v)
 
     def get_view(self, buf_id):
         buf = self.bufs.get(buf_id)
         if not buf:
             return
 
-        for v in G.WORKSPACE_WINDOW.views():
-            if not v.file_name():
-                continue
-            try:
-                rel_path = utils.to_rel_path(v.file_name())
-            except ValueError:
-                continue
-            if buf['path'] == rel_path:
-                return View(v, buf)
+        v = view_index.get(buf['path'])
+        if v:
+            return View(v, buf)
 
     def save_view(self, view):
         self.ignored_saves[view.native_id] += 1
@@ -237,10 +239,16 @@ class SublimeConnection(floo_handler.FlooHandler):
         self.temp_ignore_highlight = {}
         self.temp_ignore_highlight = {}
         self.views_changed = []
+        self.patch_worker.clear()
         self.ignored_saves = collections.defaultdict(int)
-        self._status_timeout = 0
+        self._last_status_update = 0
         self.last_highlight = None
         self.last_highlight_by_user = {}
+        view_index.rebuild()
+
+    def stop(self):
+        self.patch_worker.stop()
+        super(SublimeConnection, self).stop()
 
     def prompt_join_hangout(self, hangout_url):
         hangout_client = None
@@ -11,6 +11,156 @@ def get_text(view):
     return view.substr(sublime.Region(0, view.size()))
 
 
+def mark_view_synced(view, md5=None):
+    """ Remember that view's current contents came from us. md5 may be None if we don't know it. """
+    bid = view.buffer_id()
+    G.VIEW_TO_HASH[bid] = md5
+    G.VIEW_VERSIONS[bid] = view.change_count()
+
+
+def track_changes(view, changes):
+    """ Widen the changed region of view to cover changes (a list of sublime.TextChange) """
+    bid = view.buffer_id()
+    tracked = G.VIEW_CHANGES.get(bid)
+    if tracked is None:
+        # We haven't synced this view yet. Nothing to compare against.
+        return
+    size = view.size()
+    # Positions in each change are relative to the text right before it. Walk back from the current size.
+    sizes = []
+    for change in reversed(changes):
+        size = size - len(change.str) + (change.b.pt - change.a.pt)
+        sizes.append(size)
+    sizes.reverse()
+    _, start, suffix_len = tracked
+    for change, size in zip(changes, sizes):
+        change_suffix = size - change.b.pt
+        if start is None:
+            start, suffix_len = change.a.pt, change_suffix
+        else:
+            start = min(start, change.a.pt)
+            suffix_len = min(suffix_len, change_suffix)
+    G.VIEW_CHANGES[bid] = [view.change_count(), start, suffix_len]
+
+
+def pop_changes(view):
+    """ Returns (start, suffix_len) bounding all edits to view since the last call,
+    or None if we may have missed some. """
+    bid = view.buffer_id()
+    change_count = view.change_count()
+    tracked = G.VIEW_CHANGES.get(bid)
+    G.VIEW_CHANGES[bid] = [change_count, None, None]
+    if not tracked or tracked[0] != change_count or tracked[1] is None:
+        return None
+    return tracked[1], tracked[2]
+
+
+class ViewIndex(object):
+    """ Views in G.WORKSPACE_WINDOW by relative path, so finding a buf's view doesn't mean
+    calling to_rel_path() on every open view. Listener keeps it up to date. Views it wasn't
+    told about (eg: a preview promoted to a tab) are picked up on the next miss. """
+
+    def __init__(self):
+        # rel path -> [views]
+        self._by_path = {}
+        # view id -> rel path, or None if it's not a workspace file
+        self._paths = {}
+        self._window = None
+        self._project_path = None
+
+    def rebuild(self):
+        self._by_path = {}
+        self._paths = {}
+        self._window = G.WORKSPACE_WINDOW
+        self._project_path = G.PROJECT_PATH
+        if not G.WORKSPACE_WINDOW:
+            return
+        for view in G.WORKSPACE_WINDOW.views():
+            self._add(view)
+
+    def add(self, view):
+        """ Call whenever view opens or its file name might have changed. """
+        if self._is_stale():
+            return self.rebuild()
+        self.remove(view)
+        window = view.window()
+        if window and G.WORKSPACE_WINDOW and window.id() == G.WORKSPACE_WINDOW.id():
+            self._add(view)
+
+    def remove(self, view):
+        rel_path = self._paths.pop(view.id(), None)
+        if rel_path is None:
+            return
+        views = [v for v in self._by_path[rel_path] if v.id() != view.id()]
+        if views:
+            self._by_path[rel_path] = views
+        else:
+            del self._by_path[rel_path]
+
+    def get(self, rel_path):
+        """ Returns the first open view of rel_path, or None. """
+        if self._is_stale():
+            self.rebuild()
+        views = self._by_path.get(rel_path)
+        if not views and self._add_unseen():
+            views = self._by_path.get(rel_path)
+        view = None
+        if views:
+            view = views[0]
+            if hasattr(view, 'is_valid') and not view.is_valid():
+                # We missed a close
+                self.remove(view)
+                return self.get(rel_path)
+        if G.DEBUG:
+            self.check(rel_path)
+        return view
+
+    def check(self, rel_path):
+        if not G.WORKSPACE_WINDOW:
+            return
+        expected = set()
+        for v in G.WORKSPACE_WINDOW.views():
+            if self._rel_path(v) == rel_path:
+                expected.add(v.id())
+        actual = set([v.id() for v in self._by_path.get(rel_path, [])])
+        if expected != actual:
+            msg.error('View index is wrong for ', rel_path, ': has ', actual, ', expected ', expected, '. Rebuilding.')
+            self.rebuild()
+
+    def _is_stale(self):
+        return self._window is not G.WORKSPACE_WINDOW or self._project_path != G.PROJECT_PATH
+
+    def _rel_path(self, view):
+        file_name = view.file_name()
+        if not file_name:
+            return None
+        try:
+            return utils.to_rel_path(file_name)
+        except ValueError:
+            return None
+
+    def _add(self, view):
+        rel_path = self._rel_path(view)
+        self._paths[view.id()] = rel_path
+        if rel_path is None:
+            return
+        self._by_path.setdefault(rel_path, []).append(view)
+
+    def _add_unseen(self):
+        """ Indexes views in the window that we haven't seen. Returns True if there were any. """
+        if not G.WORKSPACE_WINDOW:
+            return False
+        added = False
+        for view in G.WORKSPACE_WINDOW.views():
+            if view.id() not in self._paths:
+                self._add(view)
+                added = True
+        return added
+
+
+view_index = ViewIndex()
+
+
 def create_view(buf):
     path = utils.get_full_path(buf['path'])
     view = G.WORKSPACE_WINDOW.open_file(path)
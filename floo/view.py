@@ -2,13 +2,13 @@ import sublime
 
 try:
     from .common import msg, shared as G, utils
-    from .sublime_utils import get_text
+    from .sublime_utils import get_text, mark_view_synced, view_index
     from .common.exc_fmt import str_e
     assert utils
 except (ImportError, ValueError):
     from common import msg, shared as G, utils
     from common.exc_fmt import str_e
-    from sublime_utils import get_text
+    from sublime_utils import get_text, mark_view_synced, view_index
 
 
 class View(object):
@@ -35,31 +35,41 @@ class View(object):
     def get_text(self):
         return get_text(self.view)
 
-    def apply_patches(self, buf, patches, username):
-        regions = []
+    def apply_patches(self, buf, patches, username, usernames=None):
+        """ usernames is who wrote each hunk in patches[2], if they weren't all username. """
+        # username -> regions
+        regions = {}
         commands = []
-        for patch in patches[2]:
+        for i, patch in enumerate(patches[2]):
             offset = patch[0]
             length = patch[1]
             patch_text = patch[2]
             region = sublime.Region(offset, offset + length)
-            regions.append(region)
+            author = (usernames and usernames[i]) or username
+            regions.setdefault(author, []).append(region)
             commands.append({'r': [offset, offset + length], 'data': patch_text})
 
         self.view.run_command('floo_view_replace_regions', {'commands': commands})
-        region_key = 'floobits-patch-' + username
-        self.view.add_regions(region_key, regions, 'floobits.patch', 'circle', sublime.DRAW_OUTLINED)
+        region_keys = []
+        for author, author_regions in regions.items():
+            region_key = 'floobits-patch-' + author
+            self.view.add_regions(region_key, author_regions, 'floobits.patch', 'circle', sublime.DRAW_OUTLINED)
+            region_keys.append(region_key)
+
+        def erase_regions():
+            for region_key in region_keys:
+                self.view.erase_regions(region_key)
         utils.cancel_timeout(self.erase_regions_timeout)
-        self.erase_regions_timeout = utils.set_timeout(self.view.erase_regions, 2000, region_key)
+        self.erase_regions_timeout = utils.set_timeout(erase_regions, 2000)
 
     def update(self, buf, message=True):
         self.buf = buf
         if message:
             msg.log('Floobits synced data for consistency: ', buf['path'])
-        G.VIEW_TO_HASH[self.view.buffer_id()] = buf['md5']
         self.view.set_read_only(False)
         try:
             self.view.run_command('floo_view_replace_region', {'r': [0, self.view.size()], 'data': buf['buf']})
+            mark_view_synced(self.view, buf['md5'])
             if message:
                 self.set_status('Floobits synced data for consistency.')
             utils.set_timeout(self.erase_status, 5000)
@@ -102,6 +112,7 @@ class View(object):
 
     def rename(self, name):
         self.view.retarget(name)
+        view_index.add(self.view)
 
     def save(self):
         if 'buf' in self.buf:
@@ -34,15 +34,17 @@ Please upgrade your operating system if you want to use this plugin. :(''')
     except Exception as e:
         print(e)
 
+# Sublime only picks up listeners from plugin modules, so ChangeTracker is imported here even though
+# nothing in this file calls it. It's None before Sublime Text 4.
 try:
     from .floo import version
-    from .floo.listener import Listener
+    from .floo.listener import Listener, ChangeTracker
     from .floo.common import reactor, shared as G, utils
     from .floo.common.exc_fmt import str_e
     assert utils
 except (ImportError, ValueError):
     from floo import version
-    from floo.listener import Listener
+    from floo.listener import Listener, ChangeTracker
     from floo.common import reactor, shared as G, utils
     from floo.common.exc_fmt import str_e
 assert Listener and version
@@ -63,12 +65,12 @@ def setup():
             now = time.time()
             old_time = settings.get('floobits-id')
             settings.set('floobits-id', now)
-            interval = utils.set_interval(reactor.tick, G.TICK_TIME)
+            reactor.start_ticking()
 
             def shutdown():
                 print('Floobits plugin updated. Shutting down old instance.', old_time)
                 try:
-                    utils.cancel_timeout(interval)
+                    reactor.stop_ticking()
                 except Exception:
                     pass
 
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+''' Checks and benchmarks the BlobCache that _upload() uses for identical files.
+
+Makes a workspace where most files are copies of a few blobs (text and binary), plus
+some unique ones, and uploads every file with a FlooHandler that has no editor or
+server. This is done with the cache and with one too small to hold anything. Every
+create_buf must decode to the file's bytes and both runs must send the same thing.
+
+    python scripts/bench_blob_cache.py [--files N] [--blobs N] [--size KB]
+'''
+import base64
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from floo import editor  # noqa: E402
+from floo.common import blob_cache, hash_cache, msg, shared as G, timers, upload_manifest  # noqa: E402
+from floo.common.handlers.floo_handler import FlooHandler  # noqa: E402
+
+
+class Client(FlooHandler):
+
+    def __init__(self, cache):
+        self.sent = []
+        super(Client, self).__init__('owner', 'workspace', {'username': 'me'}, None)
+        # reload_settings() reset it
+        msg.LOG_LEVEL = msg.LOG_LEVELS['ERROR']
+        self.blob_cache = cache
+        self.hash_cache = hash_cache.HashCache('workspace', G.PROJECT_PATH)
+        self.upload_manifest = upload_manifest.UploadManifest('workspace', G.PROJECT_PATH)
+
+    def send(self, data, cb=None):
+        self.sent.append(data)
+
+    def get_view(self, buf_id):
+        return None
+
+
+def make_files(rand, count, blobs, size):
+    contents = []
+    for i in range(blobs):
+        if i % 2:
+            contents.append(os.urandom(size))
+        else:
+            line = ('line %s of a vendored file\n' % i).encode('utf-8')
+            contents.append(line * (size // len(line)))
+    files = {}
+    for i in range(count):
+        if i < count * 4 // 5:
+            data = contents[i % blobs]
+        else:
+            data = os.urandom(rand.randint(100, 2000))
+        name = 'f%03d' % i
+        with open(os.path.join(G.PROJECT_PATH, name), 'wb') as fd:
+            fd.write(data)
+        files[name] = data
+    # Recently modified files aren't trusted by the hash cache
+    old = time.time() - 60
+    for name in files:
+        os.utime(os.path.join(G.PROJECT_PATH, name), (old, old))
+    return files
+
+
+def upload_all(files, cache):
+    client = Client(cache)
+    start = time.time()
+    for name in sorted(files):
+        client._upload(os.path.join(G.PROJECT_PATH, name))
+    elapsed = time.time() - start
+    ok = True
+    for data in client.sent:
+        buf = data['buf']
+        buf = data['encoding'] == 'base64' and base64.b64decode(buf) or buf.encode('utf-8')
+        ok = ok and buf == files[data['path']]
+    ok = ok and len(client.sent) == len(files)
+    return client.sent, elapsed, ok
+
+
+def main():
+    count = 100
+    blobs = 4
+    size = 512
+    if '--files' in sys.argv:
+        count = int(sys.argv[sys.argv.index('--files') + 1])
+    if '--blobs' in sys.argv:
+        blobs = int(sys.argv[sys.argv.index('--blobs') + 1])
+    if '--size' in sys.argv:
+        size = int(sys.argv[sys.argv.index('--size') + 1])
+
+    # Stand in for the editor, like floo/proxy.py
+    timers.timers.editor_wakeups = False
+    editor.status_message = lambda message: None
+    G.BASE_DIR = tempfile.mkdtemp()
+    G.PROJECT_PATH = tempfile.mkdtemp()
+    try:
+        files = make_files(random.Random(0), count, blobs, size * 1024)
+        total = sum(len(data) for data in files.values())
+        print('%s files, %.1f MB, %s distinct blobs copied into %s of them' % (
+            len(files), total / 1048576.0, blobs, count * 4 // 5))
+
+        # First one warms the OS file cache so the runs below compare fairly
+        upload_all(files, blob_cache.BlobCache(0))
+        plain, plain_time, plain_ok = upload_all(files, blob_cache.BlobCache(0))
+        cache = blob_cache.BlobCache()
+        cached, cached_time, cached_ok = upload_all(files, cache)
+        same = plain == cached
+
+        print('no cache   %.3fs, payloads correct: %s' % (plain_time, plain_ok))
+        print('blob cache %.3fs, payloads correct: %s, %s' % (cached_time, cached_ok, cache.stats()))
+        print('identical payloads: %s' % same)
+    finally:
+        shutil.rmtree(G.BASE_DIR, True)
+        shutil.rmtree(G.PROJECT_PATH, True)
+    sys.exit(0 if plain_ok and cached_ok and same else 1)
+
+
+if __name__ == '__main__':
+    main()
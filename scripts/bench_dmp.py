@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+''' Checks and benchmarks the match_main()/match_bitap() in floo/common/lib/dmp_monkey.py.
+
+The reference is the vendored diff_match_patch class before monkey_patch() replaced
+its matchers. First, both are run on random texts, patterns, locations and settings
+and must return the same thing. Then both apply the same edit traces to a multi-MB
+buffer: a teammate's patches made against one copy of the file, applied to ours,
+which has drifted (text inserted or deleted before the hunk, context changed near it).
+Results must be identical.
+
+    python scripts/bench_dmp.py [--cases N] [--seed N] [--size MB]
+'''
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from floo.common.lib import DMP, dmp_monkey  # noqa: E402
+
+
+def load_original():
+    ''' A fresh copy of the vendored module. monkey_patch() only touched the one floo imported. '''
+    path = os.path.join(ROOT, 'floo', 'common', 'lib', 'diff_match_patch.py')
+    with open(path) as fd:
+        source = fd.read()
+    namespace = {'__name__': 'diff_match_patch_original'}
+    exec(compile(source, path, 'exec'), namespace)
+    return namespace['diff_match_patch']
+
+
+ORIGINAL = load_original()
+
+
+class Reference(ORIGINAL):
+    ''' The vendored matchers with the same patch_apply() floo uses. '''
+    patch_apply = dmp_monkey.patch_apply
+
+
+SETTINGS = [(100, 0.375), (1000, 0.5), (0, 0.5), (10, 0.9), (1000, 0.0), (100, 1.0)]
+
+
+def random_case(rand):
+    alpha = rand.choice(['ab', 'abc', 'abcd \n', 'abcdefghij'])
+    text = ''.join(rand.choice(alpha) for _ in range(rand.randint(0, 400)))
+    if text and rand.random() < 0.7:
+        # Something near a piece of the text, with a few typos
+        start = rand.randint(0, len(text))
+        pattern = list(text[start:start + rand.randint(1, 32)])
+        for _ in range(rand.randint(0, 3)):
+            if pattern:
+                pattern[rand.randrange(len(pattern))] = rand.choice(alpha)
+        pattern = ''.join(pattern) or 'a'
+    else:
+        pattern = ''.join(rand.choice(alpha) for _ in range(rand.randint(1, 32)))
+    return text, pattern, rand.randint(-5, len(text) + 5)
+
+
+def equivalence(cases, seed):
+    rand = random.Random(seed)
+    ref = Reference()
+    saved = (DMP.Match_Distance, DMP.Match_Threshold)
+    checked = 0
+    mismatches = 0
+    for _ in range(cases):
+        text, pattern, loc = random_case(rand)
+        for distance, threshold in SETTINGS:
+            ref.Match_Distance = DMP.Match_Distance = distance
+            ref.Match_Threshold = DMP.Match_Threshold = threshold
+            pairs = [(ref.match_main(text, pattern, loc), DMP.match_main(text, pattern, loc))]
+            if text:
+                bitap_loc = max(0, min(loc, len(text)))
+                pairs.append((ref.match_bitap(text, pattern, bitap_loc), DMP.match_bitap(text, pattern, bitap_loc)))
+            for expected, got in pairs:
+                checked += 1
+                if expected != got:
+                    mismatches += 1
+                    if mismatches <= 5:
+                        print('MISMATCH %r %r loc=%s distance=%s threshold=%s: %s != %s' % (
+                            text, pattern, loc, distance, threshold, expected, got))
+    DMP.Match_Distance, DMP.Match_Threshold = saved
+    print('equivalence: %s matches, %s mismatches' % (checked, mismatches))
+    return mismatches == 0
+
+
+def source_text(size):
+    chunks = []
+    for dirpath, dirnames, filenames in os.walk(os.path.join(ROOT, 'floo')):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.endswith('.py'):
+                with open(os.path.join(dirpath, name), 'rb') as fd:
+                    chunks.append(fd.read().decode('utf-8', 'replace'))
+    text = ''.join(chunks)
+    return (text * (size // max(1, len(text)) + 1))[:size]
+
+
+def edit_traces(rand, base, count):
+    traces = []
+    for i in range(count):
+        start = rand.randrange(len(base) - 200)
+        theirs = base[:start] + 'EDIT%s' % i + base[start + rand.randint(0, 20):]
+        patches = DMP.patch_make(base, theirs)
+        drift = rand.choice([0, 3, -7, 25, 60])
+        cut = max(0, start - 500)
+        if drift > 0:
+            ours = base[:cut] + 'x' * drift + base[cut:]
+        elif drift < 0:
+            ours = base[:cut] + base[cut - drift:]
+        else:
+            ours = base
+        if rand.random() < 0.3:
+            # We changed the context too
+            ours = ours[:start + drift + 2] + 'Q' + ours[start + drift + 3:]
+        traces.append((patches, ours))
+    return traces
+
+
+def bench(seed, size):
+    rand = random.Random(seed)
+    base = source_text(size)
+    traces = edit_traces(rand, base, 60)
+    results = {}
+    for name, dmp in (('vendored', Reference()), ('floo', DMP)):
+        start = time.time()
+        results[name] = [dmp.patch_apply(patches, ours) for patches, ours in traces]
+        print('%-8s %s patches on a %.1f MB buffer: %.3fs' % (name, len(traces), len(base) / 1048576.0, time.time() - start))
+    same = results['vendored'] == results['floo']
+    clean = len([r for r in results['floo'] if all(r[1])])
+    print('identical results: %s (%s of %s applied cleanly)' % (same, clean, len(traces)))
+    return same
+
+
+def main():
+    cases = 5000
+    seed = 0
+    size = 3
+    if '--cases' in sys.argv:
+        cases = int(sys.argv[sys.argv.index('--cases') + 1])
+    if '--seed' in sys.argv:
+        seed = int(sys.argv[sys.argv.index('--seed') + 1])
+    if '--size' in sys.argv:
+        size = int(sys.argv[sys.argv.index('--size') + 1])
+    ok = equivalence(cases, seed)
+    ok = bench(seed, size * 1024 * 1024) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
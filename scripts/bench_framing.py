@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+''' Benchmarks inbound framing (floo/common/protocols/framing.py).
+
+Feeds a synthetic stream of newline-delimited JSON messages to FrameBuffer in small
+and large chunks, and checks every frame comes out intact. --old also runs the
+bytes += / partition() loop FlooProtocol used before, on a smaller stream since it's
+quadratic in the size of a message.
+
+    python scripts/bench_framing.py [--size MB] [--old]
+'''
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from floo.common.protocols import framing  # noqa: E402
+
+CHUNK_SIZES = [64, 1024, 65536, 1024 * 1024]
+# Old framing gets this much of the stream
+OLD_SIZE = 2 * 1024 * 1024
+
+
+def make_stream(size):
+    ''' Mostly small messages with a few multi-MB get_bufs, like joining a big workspace. '''
+    msgs = []
+    total = 0
+    i = 0
+    while total < size:
+        if i % 500 == 499:
+            pad = 'b' * min(3 * 1024 * 1024, size - total)
+        else:
+            pad = 'a' * (i % 700)
+        data = json.dumps({'name': 'get_buf', 'id': i, 'buf': pad}).encode('utf-8') + b'\n'
+        msgs.append(data)
+        total += len(data)
+        i += 1
+    return b''.join(msgs), len(msgs)
+
+
+def new_framing(stream, chunk):
+    fb = framing.FrameBuffer()
+    n = 0
+    for i in range(0, len(stream), chunk):
+        fb.feed(stream[i:i + chunk])
+        for frame in fb.frames():
+            n += 1
+    assert len(fb) == 0
+    return n
+
+
+def old_framing(stream, chunk):
+    buf_in = b''
+    n = 0
+    for i in range(0, len(stream), chunk):
+        buf_in += stream[i:i + chunk]
+        while True:
+            before, sep, after = buf_in.partition(b'\n')
+            if not sep:
+                break
+            buf_in = after
+            n += 1
+    return n
+
+
+def run(name, func, stream, expected):
+    for chunk in CHUNK_SIZES:
+        start = time.time()
+        n = func(stream, chunk)
+        elapsed = time.time() - start
+        assert n == expected, (name, chunk, n, expected)
+        print('%-4s %6.1f MB in %8d byte chunks: %7.3fs (%.1f MB/s)' % (
+            name, len(stream) / 1048576.0, chunk, elapsed, len(stream) / 1048576.0 / max(elapsed, 1e-6)))
+
+
+def main():
+    size = 50
+    if '--size' in sys.argv:
+        size = int(sys.argv[sys.argv.index('--size') + 1])
+    stream, count = make_stream(size * 1024 * 1024)
+    run('new', new_framing, stream, count)
+    if '--old' in sys.argv:
+        old_stream, old_count = make_stream(OLD_SIZE)
+        run('new', new_framing, old_stream, old_count)
+        run('old', old_framing, old_stream, old_count)
+
+
+if __name__ == '__main__':
+    main()
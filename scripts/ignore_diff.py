@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+''' Differential test and benchmark for floo/common/ignore.py's compiled matcher.
+
+fnmatch_is_ignored() is the loop Ignore._is_ignored() used before patterns were
+compiled. The differential test builds random trees of Ignore nodes with random
+patterns and checks both matchers agree on random paths: same answer, and the same
+rule logged as the reason. The benchmark times both on a synthetic tree with big
+ignore files.
+
+    python scripts/ignore_diff.py [--trials N] [--seed N] [--bench-only]
+'''
+import fnmatch
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from floo.common import ignore, msg  # noqa: E402
+
+ATOMS = ['*', '?', 'a', 'b', '.c', 'd/', '/a', '[ab]', '[!a]', '**', 'x*', '*.c', 'a/b', '!a', '!*.c', '^b', 'b/', '/b/*', '#', ' ', '\\', '.']
+NAMES = ['a', 'b', 'a.c', 'b.c', 'x', 'xa', 'd', 'ab', '[ab]', '.gitignore', '.floo']
+
+
+def fnmatch_is_ignored(ig, rel_path, is_dir, log):
+    ''' The old Ignore._is_ignored(). '''
+    base_path, file_name = os.path.split(rel_path)
+
+    if not is_dir and file_name in ignore.HIDDEN_WHITELIST:
+        return False
+
+    for ignore_file, patterns in ig.ignores.items():
+        for pattern in patterns:
+            orig_pattern = pattern
+            negate = False
+            match = False
+            if pattern[0] in ignore.NEGATE_PREFIXES:
+                negate = True
+                pattern = pattern[1:]
+
+            if not pattern:
+                continue
+
+            if pattern[0] == '/':
+                match = fnmatch.fnmatch(rel_path, pattern[1:])
+            else:
+                if len(pattern) > 0 and pattern[-1] == '/':
+                    if is_dir:
+                        pattern = pattern[:-1]
+                if file_name == pattern:
+                    match = True
+                elif base_path == pattern or (pattern[-1] == '/' and base_path == pattern[:-1]):
+                    match = True
+                elif fnmatch.fnmatch(file_name, pattern):
+                    match = True
+                elif fnmatch.fnmatch(rel_path, pattern):
+                    match = True
+            if match:
+                if log:
+                    msg.log(ig.is_ignored_message(rel_path, orig_pattern, ignore_file, negate))
+                if negate:
+                    return False
+                return True
+
+    split = rel_path.split('/', 1)
+    if len(split) != 2:
+        return False
+    name, new_path = split
+    child = ig.children.get(name)
+    if child:
+        return fnmatch_is_ignored(child, new_path, is_dir, log)
+    return False
+
+
+def random_patterns(rand):
+    return [''.join(rand.choice(ATOMS) for _ in range(rand.randint(1, 3))) for _ in range(rand.randint(0, 8))]
+
+
+def random_tree(rand, path='/tmp/floo_ignore_diff', depth=0):
+    ig = ignore.Ignore(path)
+    ig.ignores['.gitignore'] = random_patterns(rand)
+    if rand.random() < 0.5:
+        ig.ignores['.flooignore'] = random_patterns(rand)
+    if rand.random() < 0.3:
+        ig.ignores['/TOO_BIG/'] = [rand.choice(NAMES)]
+    if depth < 2:
+        for name in rand.sample(NAMES, rand.randint(0, 3)):
+            child = random_tree(rand, os.path.join(path, name), depth + 1)
+            child.parent = ig
+            ig.children[name] = child
+    return ig
+
+
+def check(ig, rel_path, is_dir, logged):
+    results = []
+    for func in (fnmatch_is_ignored, ignore.Ignore._is_ignored):
+        del logged[:]
+        try:
+            result = func(ig, rel_path, is_dir, True)
+        except Exception as e:
+            result = type(e).__name__
+        results.append((result, list(logged)))
+    return results
+
+
+def differential(trials, seed):
+    rand = random.Random(seed)
+    logged = []
+    log = msg.log
+    msg.log = lambda *args, **kwargs: logged.append(''.join([str(a) for a in args]))
+    checked = 0
+    mismatches = 0
+    try:
+        for trial in range(trials):
+            ig = random_tree(rand)
+            for _ in range(20):
+                rel_path = '/'.join(rand.choice(NAMES) for _ in range(rand.randint(1, 4)))
+                is_dir = rand.random() < 0.5
+                old, new = check(ig, rel_path, is_dir, logged)
+                checked += 1
+                if old != new:
+                    mismatches += 1
+                    if mismatches <= 5:
+                        print('MISMATCH %r is_dir=%s' % (rel_path, is_dir))
+                        print('  ignores: %r' % ig.ignores)
+                        print('  old: %r' % (old,))
+                        print('  new: %r' % (new,))
+    finally:
+        msg.log = log
+    print('differential: %s paths, %s mismatches' % (checked, mismatches))
+    return mismatches == 0
+
+
+def bench_tree(rand):
+    exts = ['c', 'h', 'o', 'py', 'pyc', 'js', 'map', 'log', 'tmp', 'bak']
+    words = ['build', 'dist', 'out', 'cache', 'node_modules', 'vendor', 'target', 'gen', 'obj', 'bin']
+
+    def patterns(n):
+        pats = []
+        for i in range(n):
+            kind = i % 6
+            if kind == 0:
+                pats.append('*.%s%s' % (rand.choice(exts), i))
+            elif kind == 1:
+                pats.append('%s%s/' % (rand.choice(words), i))
+            elif kind == 2:
+                pats.append('/%s/%s%s' % (rand.choice(words), rand.choice(words), i))
+            elif kind == 3:
+                pats.append('file%s.%s' % (i, rand.choice(exts)))
+            elif kind == 4:
+                pats.append('!keep%s.%s' % (i, rand.choice(exts)))
+            else:
+                pats.append('%s%s*' % (rand.choice(words), i))
+        pats.extend(['*.' + e for e in exts[:3]] + [w + '/' for w in words[:3]])
+        return pats
+
+    root = ignore.Ignore('/tmp/floo_ignore_bench')
+    root.ignores['.gitignore'] = patterns(1000)
+    root.ignores['/DEFAULT/'] = ignore.BLACKLIST
+    for i in range(50):
+        name = 'pkg%s' % i
+        child = ignore.Ignore(os.path.join(root.path, name), root)
+        child.ignores['.gitignore'] = patterns(50)
+        root.children[name] = child
+    paths = []
+    for i in range(5000):
+        parts = ['pkg%s' % rand.randrange(60)] + [rand.choice(words + ['src', 'lib', 'test']) for _ in range(rand.randint(0, 3))]
+        parts.append('f%s.%s' % (rand.randrange(5000), rand.choice(exts)))
+        paths.append(('/'.join(parts), rand.random() < 0.2))
+    return root, paths
+
+
+def bench(seed):
+    root, paths = bench_tree(random.Random(seed))
+    results = {}
+    for name, func in (('fnmatch', fnmatch_is_ignored), ('compiled', ignore.Ignore._is_ignored)):
+        start = time.time()
+        results[name] = [func(root, rel_path, is_dir, False) for rel_path, is_dir in paths]
+        print('%-8s %s paths against %s root + 50x50 child patterns: %.3fs' % (
+            name, len(paths), len(root.ignores['.gitignore']), time.time() - start))
+    assert results['fnmatch'] == results['compiled']
+    return True
+
+
+def main():
+    trials = 3000
+    seed = 1
+    if '--trials' in sys.argv:
+        trials = int(sys.argv[sys.argv.index('--trials') + 1])
+    if '--seed' in sys.argv:
+        seed = int(sys.argv[sys.argv.index('--seed') + 1])
+    ok = True
+    if '--bench-only' not in sys.argv:
+        ok = differential(trials, seed)
+    ok = bench(seed) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+''' Checks that resync_buf() converges against a stand-in server.
+
+The server keeps the text of one buf and broadcasts a patch for every edit. The
+client (a FlooHandler with no editor) misses one of those patches, or gets one that
+doesn't apply, so it has to resync. Meanwhile more edits keep coming: some before
+the server gets to the get_buf, some after. Every trial must end with the client
+holding exactly the server's text.
+
+The server runs in three modes:
+
+    delta    replies to get_buf with a patch from the md5 we sent
+    forget   like delta, but only remembers the last few versions
+    full     ignores the md5 and sends the whole buf, like servers that predate it
+
+    python scripts/resync_sim.py [--trials N] [--seed N] [--size KB]
+'''
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from floo import editor  # noqa: E402
+from floo.common import msg, shared as G, timers, utils  # noqa: E402
+from floo.common.handlers.floo_handler import FlooHandler  # noqa: E402
+from floo.common.lib import DMP  # noqa: E402
+
+BUF_ID = 1
+PATH = 'resync_sim.txt'
+
+
+def md5(text):
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+class StandInServer(object):
+
+    def __init__(self, text, mode):
+        self.text = text
+        self.mode = mode
+        # md5 -> text, oldest first
+        self.history = [(md5(text), text)]
+
+    def edit(self, rand):
+        pos = rand.randint(0, len(self.text))
+        new = self.text[:pos] + 'edit%s ' % rand.randint(0, 999) + self.text[pos + rand.randint(0, 10):]
+        data = {
+            'name': 'patch',
+            'id': BUF_ID,
+            'path': PATH,
+            'patch': DMP.patch_toText(DMP.patch_make(self.text, new)),
+            'md5_before': md5(self.text),
+            'md5_after': md5(new),
+            'username': 'teammate',
+        }
+        self.text = new
+        self.history.append((md5(new), new))
+        if self.mode == 'forget':
+            self.history = self.history[-3:]
+        return data
+
+    def get_buf(self, req):
+        data = {
+            'name': 'get_buf',
+            'id': BUF_ID,
+            'path': PATH,
+            'encoding': 'utf8',
+            'md5': md5(self.text),
+        }
+        base = None
+        if self.mode != 'full' and req.get('md5'):
+            base = dict(self.history).get(req['md5'])
+        if base is None:
+            data['buf'] = self.text
+        else:
+            data['patch'] = DMP.patch_toText(DMP.patch_make(base, self.text))
+            data['md5_before'] = req['md5']
+        return data
+
+
+class Client(FlooHandler):
+
+    def __init__(self, text):
+        self.sent = []
+        super(Client, self).__init__('owner', 'workspace', {'username': 'me'}, None)
+        # reload_settings() reset it
+        msg.LOG_LEVEL = msg.LOG_LEVELS['ERROR']
+        self.bufs[BUF_ID] = {'id': BUF_ID, 'path': PATH, 'encoding': 'utf8', 'buf': text, 'md5': md5(text)}
+        self.paths_to_ids[PATH] = BUF_ID
+
+    def send(self, data, cb=None):
+        self.sent.append(data)
+
+    def get_view(self, buf_id):
+        return None
+
+    def deliver(self, messages):
+        for data in messages:
+            self.on_data(data['name'], data)
+        self.flush_patches()
+        buf = self.bufs[BUF_ID]
+        if buf.get('timeout_id') and not buf.get('resync_md5'):
+            # md5_after didn't match. Don't wait two seconds for the timer.
+            utils.cancel_timeout(buf.pop('timeout_id'))
+            self.resync_buf(BUF_ID)
+
+    def requests(self):
+        reqs = [d for d in self.sent if d['name'] == 'get_buf']
+        self.sent = []
+        return reqs
+
+
+def base_text(rand, size):
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'floo', 'common', 'handlers')
+    with open(os.path.join(root, 'floo_handler.py'), 'rb') as fd:
+        text = fd.read().decode('utf-8')
+    text = text * (size // len(text) + 1)
+    start = rand.randrange(len(text) - size + 1)
+    return text[start:start + size]
+
+
+def trial(rand, mode, size, stats):
+    text = base_text(rand, size)
+    server = StandInServer(text, mode)
+    client = Client(text)
+    with open(utils.get_full_path(PATH), 'wb') as fd:
+        fd.write(text.encode('utf-8'))
+
+    # Some edits that arrive fine, then one that gets lost or mangled
+    client.deliver([server.edit(rand) for _ in range(rand.randint(0, 3))])
+    bad = server.edit(rand)
+    if rand.random() < 0.5:
+        bad = dict(bad, patch=DMP.patch_toText(DMP.patch_make('nothing like the buf', 'at all')))
+        client.deliver([bad])
+    client.deliver([server.edit(rand) for _ in range(rand.randint(1, 3))])
+
+    for _ in range(5):
+        reqs = client.requests()
+        if not reqs:
+            break
+        for req in reqs:
+            stats['requests'] += 1
+            # Edits the server handles before our get_buf. The reply includes them.
+            client.deliver([server.edit(rand) for _ in range(rand.randint(0, 3))])
+            reply = server.get_buf(req)
+            stats['patch' in reply and 'patch_replies' or 'full_replies'] += 1
+            stats['reply_bytes'] += len(json.dumps(reply))
+            full = dict(reply, buf=server.text)
+            full.pop('patch', None)
+            full.pop('md5_before', None)
+            stats['full_bytes'] += len(json.dumps(full))
+            client.deliver([reply])
+        # Edits after the reply get applied normally
+        client.deliver([server.edit(rand) for _ in range(rand.randint(0, 3))])
+
+    buf = client.bufs[BUF_ID]
+    return buf.get('buf') == server.text and buf['md5'] == md5(server.text)
+
+
+def main():
+    trials = 200
+    seed = 0
+    size = 64
+    if '--trials' in sys.argv:
+        trials = int(sys.argv[sys.argv.index('--trials') + 1])
+    if '--seed' in sys.argv:
+        seed = int(sys.argv[sys.argv.index('--seed') + 1])
+    if '--size' in sys.argv:
+        size = int(sys.argv[sys.argv.index('--size') + 1])
+
+    # Stand in for the editor, like floo/proxy.py. Nothing here waits on timers.
+    timers.timers.editor_wakeups = False
+    editor.get_line_endings = lambda path: '\n'
+    editor.status_message = lambda message: None
+    G.PROJECT_PATH = tempfile.mkdtemp()
+    G.PERMS = ['patch']
+    ok = True
+    try:
+        for mode in ('delta', 'forget', 'full'):
+            rand = random.Random(seed)
+            stats = dict.fromkeys(['requests', 'patch_replies', 'full_replies', 'reply_bytes', 'full_bytes'], 0)
+            converged = len([i for i in range(trials) if trial(rand, mode, size * 1024, stats)])
+            ok = ok and converged == trials
+            print('%-6s %s/%s converged, %s get_bufs: %s patch replies, %s full bufs, %.1f KB of %.1f KB full-buf replies' % (
+                mode, converged, trials, stats['requests'], stats['patch_replies'], stats['full_replies'],
+                stats['reply_bytes'] / 1024.0, stats['full_bytes'] / 1024.0))
+    finally:
+        shutil.rmtree(G.PROJECT_PATH, True)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
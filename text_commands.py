@@ -1,45 +1,68 @@
 # coding: utf-8
-import hashlib
-
 import sublime_plugin
 import sublime
 
 try:
     from .floo import sublime_utils as sutils
-    from .floo.common import shared as G
-    assert G
 except (ImportError, ValueError):
     from floo import sublime_utils as sutils
-    from floo.common import shared as G
 
 
-def transform_selections(selections, start, new_offset):
-    new_sels = []
+def _shift_points(points, shifts):
+    """ Applies every (start, offset) in shifts to points, in order. Points past start move by offset. """
+    # Hunks come in ascending order. Once a point is at or before a hunk it's before all the later
+    # ones too, so a single sorted sweep is enough.
+    for k in range(1, len(shifts)):
+        if shifts[k][0] < shifts[k - 1][0]:
+            for start, offset in shifts:
+                points = [p + offset if p > start else p for p in points]
+            return points
+
+    shifted = list(points)
+    order = sorted(range(len(points)), key=points.__getitem__)
+    i = 0
+    delta = 0
+    for start, offset in shifts:
+        while i < len(order) and points[order[i]] + delta <= start:
+            shifted[order[i]] += delta
+            i += 1
+        delta += offset
+    for index in order[i:]:
+        shifted[index] += delta
+    return shifted
+
+
+def transform_selections(selections, shifts):
+    shifts = [s for s in shifts if s[1]]
+    if not shifts:
+        return selections
+    points = []
     for sel in selections:
-        a = sel.a
-        b = sel.b
-        if sel.a > start:
-            a += new_offset
-        if sel.b > start:
-            b += new_offset
-        new_sels.append(sublime.Region(a, b))
-    return new_sels
+        points.append(sel.a)
+        points.append(sel.b)
+    points = _shift_points(points, shifts)
+    return [sublime.Region(points[i], points[i + 1]) for i in range(0, len(points), 2)]
 
 
 # The new ST3 plugin API sucks
 class FlooViewReplaceRegion(sublime_plugin.TextCommand):
     def run(self, edit, *args, **kwargs):
         selections = [x for x in self.view.sel()]  # deep copy
-        selections = self._run(edit, selections, *args, **kwargs)
+        shift = self._run(edit, *args, **kwargs)
+        if shift is None:
+            return
+        sutils.mark_view_synced(self.view)
+        self._set_selections(transform_selections(selections, [shift]))
+
+    def _set_selections(self, selections):
         self.view.sel().clear()
         for sel in selections:
             self.view.sel().add(sel)
 
-    def _run(self, edit, selections, r, data, view=None):
-        global ignore_modified_timeout
-
+    def _run(self, edit, r, data, view=None):
+        """ Replaces r with data. Returns (start, offset) for moving selections, or None if there's no view. """
         if not hasattr(self, 'view'):
-            return selections
+            return None
 
         start = max(int(r[0]), 0)
         stop = min(int(r[1]), self.view.size())
@@ -47,8 +70,7 @@ class FlooViewReplaceRegion(sublime_plugin.TextCommand):
 
         if stop - start > 10000:
             self.view.replace(edit, region, data)
-            G.VIEW_TO_HASH[self.view.buffer_id()] = hashlib.md5(sutils.get_text(self.view).encode('utf-8')).hexdigest()
-            return transform_selections(selections, stop, 0)
+            return (stop, 0)
 
         existing = self.view.substr(region)
         i = 0
@@ -67,9 +89,8 @@ class FlooViewReplaceRegion(sublime_plugin.TextCommand):
         region = sublime.Region(start + i, stop - j)
         replace_str = data[i:data_len - j]
         self.view.replace(edit, region, replace_str)
-        G.VIEW_TO_HASH[self.view.buffer_id()] = hashlib.md5(sutils.get_text(self.view).encode('utf-8')).hexdigest()
         new_offset = len(replace_str) - ((stop - j) - (start + i))
-        return transform_selections(selections, start + i, new_offset)
+        return (start + i, new_offset)
 
     def is_visible(self, *args, **kwargs):
         return False
@@ -87,13 +108,18 @@ class FlooViewReplaceRegions(FlooViewReplaceRegion):
         is_read_only = self.view.is_read_only()
         self.view.set_read_only(False)
         selections = [x for x in self.view.sel()]  # deep copy
+        shifts = []
         for command in commands:
-            selections = self._run(edit, selections, **command)
+            shift = self._run(edit, **command)
+            if shift is not None:
+                shifts.append(shift)
 
         self.view.set_read_only(is_read_only)
-        self.view.sel().clear()
-        for sel in selections:
-            self.view.sel().add(sel)
+        if not shifts:
+            return
+        # Everything's applied. Note the new contents and move selections once, not once per hunk.
+        sutils.mark_view_synced(self.view)
+        self._set_selections(transform_selections(selections, shifts))
 
     def is_visible(self, *args, **kwargs):
         return False